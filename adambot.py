@@ -1,3 +1,5 @@
+import asyncio
+from collections import OrderedDict
 from typing import Optional
 
 import discord
@@ -12,6 +14,8 @@ from tzlocal import get_localzone
 import pandas
 import json
 import libs.db.database_handle as database_handle  # not strictly a lib rn but hopefully will be in the future
+from libs.misc.metrics import registry as metrics
+from libs.misc.charts import ChartRenderer
 from scripts.utils import cog_handler
 
 
@@ -19,20 +23,41 @@ class AdamBot(Bot):
     async def get_context(self, message: discord.Message, *, cls=commands.Context) -> commands.Context:
         return await super().get_context(message, cls=cls) if cls else None
 
+    async def get_guild_prefixes(self, message: discord.Message | commands.Context) -> dict:
+        """
+        Returns the precompiled prefixes for the guild `message` is from, as a dict of:
+            "command" - tuple of prefixes that invoke commands (mentions included), longest first so the longest match always wins
+            "used" - tuple of prefixes as returned by get_used_prefixes
+
+        These are cached per guild and rebuilt only when the guild's `prefix` config key no longer matches the one they were built from.
+        """
+
+        guild_prefix = await self.get_config_key(message, "prefix") if message.guild and hasattr(self, "get_config_key") else None
+        guild_id = message.guild.id if message.guild else None
+        cached = self.prefix_cache.get(guild_id)
+        if cached is not None and cached["guild_prefix"] == guild_prefix:
+            return cached
+
+        watch_prefixes = [prefix for prefix in [guild_prefix, self.global_prefix] if type(prefix) is str and prefix]
+        command_prefixes = when_mentioned_or(*watch_prefixes)(self, message) if watch_prefixes else when_mentioned(self, message)  # Config tables aren't loaded yet or internal config doesn't specify another prefix, temporarily set to mentions only
+        cached = {
+            "guild_prefix": guild_prefix,
+            "command": tuple(sorted(dict.fromkeys(command_prefixes), key=len, reverse=True)),
+            "used": tuple([prefix for prefix in [self.user.mention, self.global_prefix if self.global_prefix else None,
+                                                 guild_prefix if guild_prefix else None] if type(prefix) is str])
+        }
+        self.prefix_cache[guild_id] = cached
+        return cached
+
     async def determine_prefix(self, bot, message: discord.Message) -> list[str]:
         """
         Procedure that determines the prefix for a guild. This determines the prefix when a global one is not being used
         "bot" is a required argument but also pointless since each AdamBot object isn't going to be trying to handle *other* AdamBot objects' prefixes
         """
 
-        watch_prefixes = [await self.get_config_key(message, "prefix") if message.guild else None, self.global_prefix]
-        if watch_prefixes != [None] * len(watch_prefixes):
-            return when_mentioned_or(*tuple([prefix for prefix in watch_prefixes if type(prefix) is str]))(self, message)  # internal conf prefix or guild conf prefix can be used
-        else:
-            # Config tables aren't loaded yet or internal config doesn't specify another prefix, temporarily set to mentions only
-            return when_mentioned(self, message)
+        return list((await self.get_guild_prefixes(message))["command"])  # internal conf prefix or guild conf prefix can be used
 
-    async def get_used_prefixes(self, message: discord.Message) -> list[str]:
+    async def get_used_prefixes(self, message: discord.Message | commands.Context) -> list[str]:
         """
         Gets the prefixes that can be used to invoke a command in the guild where the message is from
         """
@@ -40,9 +65,81 @@ class AdamBot(Bot):
         if not hasattr(self, "get_config_key"):
             return []  # config cog not loaded yet
 
-        guild_prefix = await self.get_config_key(message, "prefix")
-        return [prefix for prefix in [self.user.mention, self.global_prefix if self.global_prefix else None,
-                                      guild_prefix if guild_prefix else None] if type(prefix) is str]
+        return list((await self.get_guild_prefixes(message))["used"])
+
+    async def get_invoked_prefix(self, message: discord.Message) -> Optional[str]:
+        """
+        Returns the (longest) used prefix that `message` starts with, or None if it doesn't start with one.
+        The result is remembered for recent messages so every listener looking at the same message shares one resolution.
+        """
+
+        memo = self.invoked_prefixes.get(message.id)
+        if memo is not None and memo[0] == message.content:  # content check means edits get resolved again
+            return memo[1]
+
+        prefixes = sorted(await self.get_used_prefixes(message), key=len, reverse=True)
+        invoked = next((prefix for prefix in prefixes if message.content.startswith(prefix)), None)
+        self.invoked_prefixes[message.id] = (message.content, invoked)
+        if len(self.invoked_prefixes) > 512:
+            self.invoked_prefixes.popitem(last=False)
+        return invoked
+
+    async def get_message_info(self, message: discord.Message) -> dict:
+        """
+        Returns what listeners commonly need to know about a message, worked out once per message and shared by every listener:
+            "ctx" - the commands.Context for the message
+            "prefix" - the prefix the message starts with, or None
+            "is_command" - whether the message invokes a valid command
+            "is_staff" - whether the author is staff in the guild the message is from
+
+        Listeners running at the same time for the same message wait on the same resolution. Edited messages are resolved again.
+        """
+
+        memo = self.message_info.get(message.id)
+        if memo is None or memo[0] != message.content:
+            memo = (message.content, asyncio.ensure_future(self._make_message_info(message)))
+            self.message_info[message.id] = memo
+            if len(self.message_info) > 512:
+                self.message_info.popitem(last=False)
+        return await asyncio.shield(memo[1])
+
+    async def _make_message_info(self, message: discord.Message) -> dict:
+        ctx = await self.get_context(message)
+        return {
+            "ctx": ctx,
+            "prefix": await self.get_invoked_prefix(message),
+            "is_command": ctx.valid,
+            "is_staff": await self.is_staff(ctx) if message.guild and hasattr(self, "is_staff") else False
+        }
+
+    async def on_message(self, message: discord.Message) -> None:
+        """
+        Processes commands using the shared message info, so command handling doesn't build its own context on top of the listeners'
+        """
+
+        if message.author.bot:
+            return
+
+        await self.invoke((await self.get_message_info(message))["ctx"])
+
+    def dispatch(self, event_name: str, /, *args, **kwargs) -> None:
+        self.metrics.increment("events_total", {"event": event_name})
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def _run_event(self, coro, event_name: str, *args, **kwargs) -> None:
+        """
+        Every listener (cog listeners included) is run through here, so this is where their run time gets measured
+        """
+
+        with self.metrics.timer("listener_seconds", {"listener": getattr(coro, "__qualname__", event_name)}):
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def invoke(self, ctx: commands.Context, /) -> None:
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        with self.metrics.timer("command_seconds", {"command": ctx.command.qualified_name}):
+            await super().invoke(ctx)
 
     def __init__(self, start_time: float, config_path: str = "config.json", command_prefix: str = "", *args,
                  **kwargs) -> None:
@@ -50,6 +147,12 @@ class AdamBot(Bot):
         self.cog_handler = cog_handler.CogHandler(self)
         self.kwargs = kwargs
         self.global_prefix = self.internal_config.get("global_prefix")
+        self.prefix_cache = {}  # guild_id -> precompiled prefixes, see get_guild_prefixes
+        self.invoked_prefixes = OrderedDict()  # message_id -> (content, invoked prefix) for recent messages, see get_invoked_prefix
+        self.message_info = OrderedDict()  # message_id -> (content, future of the info) for recent messages, see get_message_info
+        self.metrics = metrics
+        self.metrics_port = self.internal_config.get("metrics_port", 0)  # 0 means the metrics endpoint isn't served
+        self.charts = ChartRenderer(self.internal_config.get("chart_workers", 1))  # Draws charts in worker processes, off the event loop
         self.kwargs["command_prefix"] = self.determine_prefix if not command_prefix else when_mentioned_or(command_prefix)
 
         self.cog_handler.preload_core_cogs()
@@ -60,6 +163,7 @@ class AdamBot(Bot):
         else:
             print("[X]    No cogs specified.")
 
+        kwargs.setdefault("max_messages", self.internal_config.get("max_messages", 1000))  # discord.py's message cache, the logging cog keeps its own compact store
         super().__init__(*args, intents=self.cog_handler.make_intents(list(dict.fromkeys(self.cog_handler.intent_list))), **kwargs)
 
         self.db_start = time.time()
@@ -90,6 +194,7 @@ class AdamBot(Bot):
         (await ctx.send(p_s), print(p_s)) if ctx else print(p_s)
         if hasattr(self, "pool"):
             self.pool.terminate()  # TODO: Make this more graceful
+        self.charts.close()
         c_s = "Closing connection to Discord..."
         (await ctx.send(c_s), print(c_s)) if ctx else print(c_s)
         try:
@@ -149,12 +254,16 @@ class AdamBot(Bot):
 
         self.internal_config = []
         self.pool: \
-            asyncpg.pool.Pool = await asyncpg.create_pool(self.db_url + "?sslmode=require", max_size=self.connections)
+            asyncpg.pool.Pool = await database_handle.create_pool(self.db_url + "?sslmode=require", max_size=self.connections)
 
         await database_handle.introduce_tables(self.pool, self.cog_handler.db_tables)
         await database_handle.insert_cog_db_columns_if_not_exists(self.pool, self.cog_handler.db_tables)
         print(f"DB took {time.time() - self.db_start} seconds to connect to")
 
+        if self.metrics_port:
+            self.metrics_server = await self.metrics.serve(self.metrics_port)
+            print(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+
         try:
             await self.start(token)
         except Exception as e:
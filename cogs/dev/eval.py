@@ -85,6 +85,24 @@ class Eval(commands.Cog):
             except Exception as e:
                 await ctx.send(f"EXCEPTION: {e}")
 
+    @commands.command(pass_context=True)
+    @is_dev()
+    async def metrics(self, ctx: commands.Context, *, name_filter: str = "") -> None:
+        """
+        Sends the latency percentiles of listeners, commands and DB queries (slowest first), optionally only those containing `name_filter`,
+        along with the event counts
+        """
+
+        rows = self.bot.metrics.summary_rows(name_filter)
+        final_str = f"{'metric':<22}{'count':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  labels\n"
+        for name, labels, count, p50, p95, p99 in rows:
+            final_str += f"{name:<22}{count:>10}{p50 * 1000:>10.2f}{p95 * 1000:>10.2f}{p99 * 1000:>10.2f}  {labels}\n"
+
+        events = sorted(self.bot.metrics.counters.get("events_total", {}).items(), key=lambda item: item[1], reverse=True)
+        final_str += "\nevent counts\n" + "\n".join([f"{count:>10}  {dict(key).get('event')}" for key, count in events])
+
+        await self.bot.send_text_file(final_str, ctx.channel, "metrics")
+
 
 async def setup(bot) -> None:
     await bot.add_cog(Eval(bot))
@@ -1,9 +1,8 @@
 ﻿import discord
 from discord.ext import commands
 import asyncio
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
+from datetime import datetime, timedelta, timezone
+from libs.misc.charts import line_chart
 from libs.misc.decorators import is_staff
 
 
@@ -14,25 +13,96 @@ class Demographics(commands.Cog):
 
     def __init__(self, bot) -> None:
         self.bot = bot
+        self.chart_points = 200
 
     @commands.Cog.listener()
     async def on_ready(self) -> None:
-        await self.bot.tasks.register_task_type("demographic_sample", self.handle_demographic_sample, needs_extra_columns={"demographic_role_id": "bigint"})
+        config = self.bot.cog_handler.give_config(self) or {}
+        self.chart_points = config.get("chart_points", self.chart_points)
+        await self.bot.tasks.register_task_type("demographic_sample", self.handle_demographic_sample, needs_extra_columns={"demographic_guild_id": "bigint"})
 
-    async def handle_demographic_sample(self, data: dict) -> None:
         async with self.bot.pool.acquire() as connection:
-            demographic_role_id = data["demographic_role_id"]
-            results = await connection.fetch("SELECT role_id, guild_id, sample_rate FROM demographic_roles WHERE id = $1", demographic_role_id)
+            await connection.execute("CREATE INDEX IF NOT EXISTS demographic_samples_role_time_idx ON demographic_samples (role_reference, taken_at);")
+            # Samples used to be scheduled as one task per role, swap any of those left over for one task per guild
+            await connection.execute("DELETE FROM tasks WHERE task_name = 'demographic_sample' AND demographic_guild_id IS NULL;")
+            unscheduled = await connection.fetch("""SELECT guild_id, MIN(COALESCE(next_sample, now())) AS next_sample FROM demographic_roles
+                                                    WHERE guild_id NOT IN (SELECT demographic_guild_id FROM tasks WHERE task_name = 'demographic_sample' AND demographic_guild_id IS NOT NULL)
+                                                    GROUP BY guild_id;""")
+        for guild in unscheduled:
+            await self.bot.tasks.submit_task("demographic_sample", guild["next_sample"], extra_columns={"demographic_guild_id": guild["guild_id"]})
+
+    async def get_series(self, guild_id: int, since: datetime = None, until: datetime = None) -> list:
+        """
+        Returns the samples of all the guild's tracked roles between `since` and `until` (all of them if not given) as records of role_id, bucket and n,
+        ordered by role then time.
+
+        The range is split into at most `chart_points` equal buckets and each role's samples are averaged within them in the DB,
+        so the number of rows (and the time taken to draw them) stays the same however much history there is.
+        """
+
+        async with self.bot.pool.acquire() as connection:
+            return await connection.fetch("""WITH samples AS (
+                                                 SELECT r.role_id, s.taken_at, s.n FROM demographic_samples s JOIN demographic_roles r ON r.id = s.role_reference
+                                                 WHERE r.guild_id = $1 AND ($2::timestamptz IS NULL OR s.taken_at >= $2) AND ($3::timestamptz IS NULL OR s.taken_at < $3)
+                                             ), span AS (
+                                                 SELECT MIN(taken_at) AS first_at, GREATEST(EXTRACT(EPOCH FROM MAX(taken_at) - MIN(taken_at)) / $4::int, 1) AS width FROM samples
+                                             )
+                                             SELECT role_id, span.first_at + make_interval(secs => LEAST(FLOOR(EXTRACT(EPOCH FROM taken_at - span.first_at) / span.width), $4::int - 1) * span.width) AS bucket, ROUND(AVG(n))::int AS n
+                                             FROM samples, span GROUP BY role_id, bucket ORDER BY role_id, bucket;""", guild_id, since, until, self.chart_points)
+
+    @staticmethod
+    def role_ids(member: discord.Member):
+        """
+        Returns the raw IDs of `member`'s roles. member.roles would build (and sort) Role objects for every member counted,
+        so this reads Member._roles instead, the SnowflakeList of role IDs discord.py 2.x keeps on each member. Fall back to member.roles if that goes away.
+        """
+
+        roles = getattr(member, "_roles", None)
+        return roles if roles is not None else [role.id for role in member.roles]
+
+    @staticmethod
+    def count_members(guild: discord.Guild, role_ids: list[int]) -> dict[int, int]:
+        """
+        Returns how many members of `guild` have each of `role_ids`, counted in a single pass over the members
+        """
+
+        tracked = set(role_ids)
+        counts = dict.fromkeys(tracked, 0)
+        for member in guild.members:
+            for role_id in tracked.intersection(Demographics.role_ids(member)):
+                counts[role_id] += 1
+        return counts
+
+    async def take_samples(self, guild: discord.Guild, roles: list) -> None:
+        """
+        Samples all of `roles` (records with the demographic_roles `id` and `role_id`) at once and writes the samples together
+        """
+
+        counts = self.count_members(guild, list({role["role_id"] for role in roles}))
+        async with self.bot.pool.acquire() as connection:
+            await connection.executemany("INSERT INTO demographic_samples (n, role_reference) VALUES ($1, $2)", [(counts[role["role_id"]], role["id"]) for role in roles])
 
-            guild = self.bot.get_guild(results[0][1])
-            role_id = results[0][0]
-            sample_rate = results[0][2]
-            n = len([x for x in guild.members if role_id in [y.id for y in x.roles]])
+    async def handle_demographic_sample(self, data: dict) -> None:
+        """
+        Samples every tracked role in the guild that is due (or nearly due, so roles on the same schedule share a pass), then schedules the guild's next sample
+        """
 
-            await connection.execute("INSERT INTO demographic_samples (n, role_reference) VALUES ($1, $2)", n, demographic_role_id)
+        guild_id = data["demographic_guild_id"]
+        if guild_id is None:
+            return  # An old per-role task, on_ready replaces these with per-guild ones
+        guild = self.bot.get_guild(guild_id)
+        async with self.bot.pool.acquire() as connection:
+            if not guild:  # Unavailable for now, try again tomorrow
+                next_sample = datetime.now(timezone.utc) + timedelta(days=1)
+            else:
+                due = await connection.fetch("SELECT id, role_id FROM demographic_roles WHERE guild_id = $1 AND (next_sample IS NULL OR next_sample <= now() + interval '5 minutes');", guild_id)
+                if due:
+                    await self.take_samples(guild, due)
+                    await connection.execute("UPDATE demographic_roles SET next_sample = now() + make_interval(days => sample_rate) WHERE id = ANY($1::int[]);", [role["id"] for role in due])
+                next_sample = await connection.fetchval("SELECT MIN(next_sample) FROM demographic_roles WHERE guild_id = $1;", guild_id)
 
-            if data["task_name"] == "demographic_sample":  # IF NOT A ONE OFF SAMPLE, PERFORM IT AGAIN
-                await self.bot.tasks.submit_task("demographic_sample", datetime.utcnow() + timedelta(days=sample_rate), extra_columns={"demographic_role_id": demographic_role_id})
+        if next_sample:  # Nothing left to track otherwise
+            await self.bot.tasks.submit_task("demographic_sample", next_sample, extra_columns={"demographic_guild_id": guild_id})
 
     async def _get_roles(self, guild: discord.Guild) -> list[int]:
         """
@@ -48,22 +118,27 @@ class Demographics(commands.Cog):
         Adds a role to the demographic todo table such that it gets sampled regularly.
         """
 
+        now = datetime.now(timezone.utc)
+        midnight = datetime(now.year, now.month, now.day, 23, 59, 59, tzinfo=timezone.utc)  # Midnight of the current day
         async with self.bot.pool.acquire() as connection:
-            await connection.execute("INSERT INTO demographic_roles (sample_rate, guild_id, role_id) VALUES ($1, $2, $3);", sample_rate, role.guild.id, role.id)
-            demographic_role_id = await connection.fetchval("SELECT MAX(id) FROM demographic_roles;")
+            await connection.execute("INSERT INTO demographic_roles (sample_rate, guild_id, role_id, next_sample) VALUES ($1, $2, $3, $4);", sample_rate, role.guild.id, role.id, midnight)
 
-            now = datetime.utcnow()
-            midnight = datetime(now.year, now.month, now.day, 23, 59, 59)  # Midnight of the current day
-            await self.bot.tasks.submit_task("demographic_sample", midnight, extra_columns={"demographic_role_id": demographic_role_id})
+            # The guild's task only needs moving if it isn't already due by midnight
+            scheduled = await connection.fetchrow("SELECT id, task_time FROM tasks WHERE task_name = 'demographic_sample' AND demographic_guild_id = $1 ORDER BY task_time LIMIT 1;", role.guild.id)
+            if scheduled and scheduled["task_time"] <= midnight:
+                return
+            await connection.execute("DELETE FROM tasks WHERE task_name = 'demographic_sample' AND demographic_guild_id = $1;", role.guild.id)
+        await self.bot.tasks.submit_task("demographic_sample", midnight, extra_columns={"demographic_guild_id": role.guild.id})
 
-    async def _require_sample(self, role: discord.Role) -> None:
+    async def _require_sample(self, guild: discord.Guild, role_ids: list[int]) -> None:
         """
-        Adds a TODO saying that a sample is required ASAP.
+        Samples the given tracked roles straight away, without changing when they are next sampled.
         """
 
         async with self.bot.pool.acquire() as connection:
-            demographic_role_id = await connection.fetchval("SELECT id from demographic_roles WHERE role_id = $1", role.id)
-            await self.bot.tasks.submit_task("demographic_sample", datetime.utcnow(), extra_columns={"demographic_role_id": demographic_role_id})
+            roles = await connection.fetch("SELECT id, role_id FROM demographic_roles WHERE guild_id = $1 AND role_id = ANY($2::bigint[]);", guild.id, role_ids)
+        if roles:
+            await self.take_samples(guild, roles)
 
     async def _remove_role(self, role: discord.Role) -> None:
         """
@@ -71,9 +146,8 @@ class Demographics(commands.Cog):
         """
 
         async with self.bot.pool.acquire() as connection:
-            demographic_role_id = await connection.fetchval("SELECT id FROM demographic_roles WHERE role_id = $1;", role.id)
             await connection.execute("DELETE FROM demographic_roles WHERE role_id = $1;", role.id)
-            await connection.execute("DELETE FROM tasks WHERE demographic_role_id = $1", demographic_role_id)
+            await connection.execute("DELETE FROM tasks WHERE task_name = 'demographic_sample' AND demographic_guild_id = $1 AND NOT EXISTS (SELECT 1 FROM demographic_roles WHERE guild_id = $1);", role.guild.id)
 
     @staticmethod
     async def _role_error(ctx: commands.Context, error) -> None:
@@ -193,8 +267,7 @@ class Demographics(commands.Cog):
                 return
 
             if response.content.lower() == "yes":
-                for role in guild_tracked_roles:
-                    await self._require_sample(ctx.guild.get_role(role))
+                await self._require_sample(ctx.guild, guild_tracked_roles)
                 await ctx.send("All roles sampled! :ok_hand:")
             elif response.content.lower() == "no":
                 await ctx.send("Operation cancelled.")
@@ -206,8 +279,8 @@ class Demographics(commands.Cog):
             await ctx.send("This role is not currently being tracked!")
             return
 
-        await self._require_sample(role)
-        await ctx.send("A sample has been taken, it may take a few seconds to be registered in the database. :ok_hand:")
+        await self._require_sample(ctx.guild, [role.id])
+        await ctx.send("A sample has been taken! :ok_hand:")
 
     @demographics.command(pass_context=True)
     @commands.guild_only()
@@ -254,27 +327,37 @@ class Demographics(commands.Cog):
 
     @demographics.command(pass_context=True)
     @commands.guild_only()
-    async def chart(self, ctx: commands.Context) -> None:
-        """View a guild's demographics over time"""
-        fig, ax = plt.subplots()
-        async with self.bot.pool.acquire() as connection:
-            role_data = await connection.fetch("SELECT role_id, id FROM demographic_roles WHERE guild_id = $1", ctx.guild.id)
-            
-            for role in role_data:
-                data = await connection.fetch("SELECT taken_at, n FROM demographic_samples WHERE role_reference = $1", role[1])
-                role = ctx.guild.get_role(role[0])
-                rgb_scaled_tuple = tuple(x/255 for x in role.color.to_rgb())  # Scale 0-255 integers down to 0-1 floats
-
-                ax.plot([x[0] for x in data], [x[1] for x in data], linewidth=1, markersize=2, color=rgb_scaled_tuple, label=role.name)
-
-        ax.set(xlabel="Time", ylabel="Frequency", title=f"{ctx.guild.name}'s  demographics ({ctx.guild.member_count} members)")
-        ax.grid()
-        ax.legend(loc="upper left")
-        ax.set_ylim(bottom=0)
-        ax.fmt_xdata = DateFormatter("% Y-% m-% d % H:% M:% S")
-        fig.autofmt_xdate()
+    async def chart(self, ctx: commands.Context, since: str = None, until: str = None) -> None:
+        """View a guild's demographics over time, optionally between the dates `since` and `until` (YYYY-MM-DD)"""
+        try:
+            since_date = datetime.strptime(since, "%Y-%m-%d").replace(tzinfo=timezone.utc) if since else None
+            until_date = datetime.strptime(until, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1) if until else None  # Include all of the last day
+        except ValueError:
+            await ctx.send("Dates must be given as YYYY-MM-DD, e.g. 2022-01-31")
+            return
 
-        await self.bot.send_image_file(fig, ctx.channel, "demographics-data")
+        lines = {}
+        for sample in await self.get_series(ctx.guild.id, since_date, until_date):
+            role = ctx.guild.get_role(sample["role_id"])
+            if not role:
+                continue
+            if role.id not in lines:
+                rgb_scaled_tuple = tuple(x/255 for x in role.color.to_rgb())  # Scale 0-255 integers down to 0-1 floats
+                lines[role.id] = {"x": [], "y": [], "colour": rgb_scaled_tuple, "label": role.name}
+            lines[role.id]["x"].append(sample["bucket"])
+            lines[role.id]["y"].append(sample["n"])
+
+        chart = {
+            "lines": list(lines.values()),
+            "xlabel": "Time",
+            "ylabel": "Frequency",
+            "title": f"{ctx.guild.name}'s  demographics ({ctx.guild.member_count} members)",
+            "legend": True,
+            "dates": True
+        }
+        image = await self.bot.charts.render(line_chart, chart, key=("demographics", ctx.guild.id, since_date, until_date), version=repr(chart))  # What gets drawn, so every process agrees on when it needs redrawing
+
+        await self.bot.send_image_file(image, ctx.channel, "demographics-data")
 
 
 async def setup(bot) -> None:
@@ -1,3 +1,10 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
 import discord
 from discord.ext import commands
 from discord import Embed, Colour
@@ -5,64 +12,381 @@ from libs.misc.utils import get_user_avatar_url
 from math import ceil
 
 
+class LogQueue:
+    """
+    Outbound queue for a single log channel.
+
+    Queued logs are sent in batches of up to 10 embeds per message, waiting a short window for a burst to build up first.
+    Only one message is ever being sent at a time, so when Discord rate limits the channel the queue fills up, and once it's full
+    anything adding to it waits for room (backpressure) rather than piling up more sends.
+    """
+
+    max_embeds = 10  # Most embeds Discord allows in one message
+    max_chars = 6000  # Most characters Discord allows across all the embeds in one message
+
+    def __init__(self, channel: discord.TextChannel | discord.Thread, render: Callable, window: float = 2, max_pending: int = 500) -> None:
+        self.channel = channel
+        self.render = render  # Turns a queued item into an Embed (or None to drop it) when it's about to be sent
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = []
+        self.mergeable = {}  # Links merge key -> queued item that later items with the same key get merged into
+        self.has_room = asyncio.Condition()
+        self.worker = None
+
+    async def put(self, item: dict) -> None:
+        async with self.has_room:
+            await self.has_room.wait_for(lambda: len(self.pending) < self.max_pending)
+            self.pending.append(item)
+        self.start()
+
+    def get_mergeable(self, key: tuple) -> Optional[dict]:
+        return self.mergeable.get(key, None)
+
+    async def put_mergeable(self, key: tuple, item: dict) -> None:
+        self.mergeable[key] = item
+        await self.put(item)
+
+    def start(self) -> None:
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+    def take_batch(self) -> list[Embed]:
+        batch, size = [], 0
+        while self.pending and len(batch) < self.max_embeds:
+            embed = self.render(self.pending[0])
+            if embed is not None and batch and size + len(embed) > self.max_chars:
+                break
+
+            item = self.pending.pop(0)
+            if self.mergeable.get(item.get("key", None), None) is item:
+                del self.mergeable[item["key"]]
+            if embed is not None:
+                batch.append(embed)
+                size += len(embed)
+        return batch
+
+    async def run(self) -> None:
+        while self.pending:
+            if len(self.pending) < self.max_embeds:
+                await asyncio.sleep(self.window)  # Let a burst build up into one message
+
+            batch = self.take_batch()
+            async with self.has_room:
+                self.has_room.notify_all()
+
+            if batch:
+                try:
+                    await self.channel.send(embeds=batch)  # discord.py waits out any rate limit before this returns
+                except discord.HTTPException as e:
+                    print(f"Couldn't send logs to {self.channel.id}\n{type(e).__name__}: {e}")
+
+
+StoredMessage = namedtuple("StoredMessage", ["channel_id", "author_id", "author_name", "content", "reference_id"])
+
+
+class MessageStore:
+    """
+    Compact store of recent message contents, so deletes and edits can be logged for messages discord.py no longer has cached.
+
+    The newest `memory_size` messages are kept in memory as small tuples. If a `spill_path` is given, older ones are written to an SQLite file there
+    (in batches, off the event loop) which keeps the newest `spill_size` of them.
+    """
+
+    def __init__(self, memory_size: int = 5000, spill_path: str = None, spill_size: int = 100000) -> None:
+        self.memory = OrderedDict()  # Links message_id -> StoredMessage, oldest first
+        self.memory_size = memory_size
+        self.spill_size = spill_size
+        self.spill_buffer = {}  # Links message_id -> StoredMessage pushed out of memory but not written yet
+        self.writing = {}  # Same as above for the batch being written right now
+        self.flushing = None
+        self.db = self.executor = None
+        if spill_path:
+            self.executor = ThreadPoolExecutor(max_workers=1)  # SQLite connection is only ever used from this thread
+            self.db = sqlite3.connect(spill_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages (message_id INTEGER PRIMARY KEY, channel_id INTEGER, author_id INTEGER, author_name TEXT, content TEXT, reference_id INTEGER)")
+            self.db.commit()
+
+    def put(self, message_id: int, message: StoredMessage) -> None:
+        self.memory[message_id] = message
+        self.memory.move_to_end(message_id)
+        self.spill_buffer.pop(message_id, None)
+        while len(self.memory) > self.memory_size:
+            old_id, old = self.memory.popitem(last=False)
+            if self.db:
+                self.spill_buffer[old_id] = old
+
+        if len(self.spill_buffer) >= 100 and (not self.flushing or self.flushing.done()):
+            self.flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> None:
+        self.writing, self.spill_buffer = self.spill_buffer, {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._write, list(self.writing.items()))
+        finally:
+            self.writing = {}
+
+    def _write(self, rows: list[tuple[int, StoredMessage]]) -> None:
+        self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", [(message_id, *message) for message_id, message in rows])
+        self.db.execute("DELETE FROM messages WHERE message_id <= (SELECT message_id FROM messages ORDER BY message_id DESC LIMIT 1 OFFSET ?)", (self.spill_size,))  # IDs are snowflakes, so smallest is oldest
+        self.db.commit()
+
+    def _read(self, message_id: int) -> Optional[StoredMessage]:
+        row = self.db.execute("SELECT channel_id, author_id, author_name, content, reference_id FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+        return StoredMessage(*row) if row else None
+
+    def _delete(self, message_id: int) -> None:
+        self.db.execute("DELETE FROM messages WHERE message_id = ?", (message_id,))
+        self.db.commit()
+
+    async def get(self, message_id: int) -> Optional[StoredMessage]:
+        message = self.memory.get(message_id, None) or self.spill_buffer.get(message_id, None) or self.writing.get(message_id, None)
+        if message or not self.db:
+            return message
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._read, message_id)
+
+    async def pop(self, message_id: int) -> Optional[StoredMessage]:
+        message = await self.get(message_id)
+        self.memory.pop(message_id, None)
+        self.spill_buffer.pop(message_id, None)
+        if self.db and message:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._delete, message_id)
+        return message
+
+    async def close(self) -> None:
+        """
+        Closes the SQLite file and its thread, if there is one
+        """
+
+        if not self.db:
+            return
+        if self.flushing and not self.flushing.done():
+            await asyncio.wait([self.flushing])
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.db.close)
+        self.executor.shutdown(wait=False)
+        self.db = self.executor = None
+
+
 class Logging(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
-        self.previous_inv_log_embeds = []
+        self.recent_invite_logs = OrderedDict()  # Links fingerprint of a recently sent invite log -> when it was sent, oldest first
+        self.recent_invite_logs_size = 1000
+        self.recent_invite_logs_ttl = 3600
         self.guilds = []
-        self.invites = {}
+        self.invites = {}  # Links guild_id -> {code: discord.Invite}, kept up to date by invite events and the fetches made when members join
+        self.pending_joins = {}  # Links guild_id -> joins waiting for the next invite fetch, see get_used_invites
+        self.invite_locks = {}  # Links guild_id -> lock so only one invite fetch per guild runs at a time
+        self.log_queues = {}  # Links log channel_id -> LogQueue
+        self.batch_window_seconds = 2
+        self.max_pending_logs = 500
+        self.message_store = MessageStore()  # Memory only until on_ready swaps in one made from the config
+        self.message_store_configured = False
 
     @staticmethod
-    async def get_all_invites(guild: discord.Guild) -> list[discord.Invite]:
-        return await guild.invites() + ([await guild.vanity_invite()] if "VANITY_URL" in guild.features else [])
+    async def get_all_invites(guild: discord.Guild) -> dict[str, discord.Invite]:
+        invites = await guild.invites() + ([await guild.vanity_invite()] if "VANITY_URL" in guild.features else [])
+        return {invite.code: invite for invite in invites if invite}
+
+    async def load_invites(self, guild: discord.Guild) -> None:
+        try:
+            self.invites[guild.id] = await self.get_all_invites(guild)
+        except discord.HTTPException:
+            self.invites[guild.id] = {}  # Probably missing permissions, joins just won't be attributed
+
+    async def get_used_invites(self, member: discord.Member) -> list[discord.Invite]:
+        """
+        Returns the invites whose uses went up since they were last looked at, i.e. the invite(s) `member` could have joined with.
+
+        Joins that happen while an invite fetch for the guild is waiting to start share that fetch, so a raid costs a handful of fetches
+        instead of one per join. Fetches for a guild run one at a time, so each one is compared against the result of the previous one.
+        """
+
+        guild = member.guild
+        batch = self.pending_joins.get(guild.id, None)
+        if not batch:
+            batch = self.pending_joins[guild.id] = {"members": 0, "result": asyncio.get_running_loop().create_future()}
+            asyncio.create_task(self.fetch_used_invites(guild, batch))
+        batch["members"] += 1
+        return await asyncio.shield(batch["result"])
+
+    async def fetch_used_invites(self, guild: discord.Guild, batch: dict) -> None:
+        try:
+            async with self.invite_locks.setdefault(guild.id, asyncio.Lock()):
+                if self.pending_joins.get(guild.id, None) is batch:
+                    del self.pending_joins[guild.id]  # Joins from here on need a fetch that starts after them
+
+                new_invites = await self.get_all_invites(guild)  # Failing here leaves the joins' invite unknown, rather than put down to Server Discovery
+                old_invites = self.invites.get(guild.id, {})
+                self.invites[guild.id] = new_invites
+                batch["result"].set_result([invite for code, invite in new_invites.items() if invite.uses > (old_invites[code].uses if code in old_invites else 0)])  # else 0-use invites will be logged
+        except Exception as e:  # Every join sharing this fetch is waiting on the result, so it must always be given one
+            if self.pending_joins.get(guild.id, None) is batch:
+                del self.pending_joins[guild.id]
+            if not batch["result"].done():
+                batch["result"].set_exception(e)
 
     async def get_log_channel(self, ctx: discord.ext.commands.Context | discord.Guild, name: str) -> discord.TextChannel | discord.Thread:
         spec_channel = self.bot.get_channel(await self.bot.get_config_key(ctx, f"{name}_log_channel"))
         return spec_channel if spec_channel and spec_channel.permissions_for(ctx.me if type(ctx) is discord.Guild else ctx.guild.me).send_messages else self.bot.get_channel(await self.bot.get_config_key(ctx, "misc_log_channel"))
 
+    def get_log_queue(self, channel: discord.TextChannel | discord.Thread) -> LogQueue:
+        queue = self.log_queues.get(channel.id, None)
+        if not queue:
+            queue = self.log_queues[channel.id] = LogQueue(channel, self.render_log, window=self.batch_window_seconds, max_pending=self.max_pending_logs)
+        queue.channel = channel  # In case the channel object has been replaced
+        return queue
+
+    async def send_log(self, channel: discord.TextChannel | discord.Thread, embed: Embed) -> None:
+        """
+        Queues `embed` to be sent to the log `channel` in the next batch
+        """
+
+        await self.get_log_queue(channel).put({"embed": embed})
+
+    async def send_role_change(self, channel: discord.TextChannel | discord.Thread, before: discord.Member, after: discord.Member) -> None:
+        """
+        Queues a role change log, merging it into the member's role change that's still waiting to be sent (if there is one)
+        so that e.g. mass role assignments end up as one log per member
+        """
+
+        removed_roles, added_roles = await self.role_comparison(before, after)
+        queue = self.get_log_queue(channel)
+        key = ("roles", after.guild.id, after.id)
+        item = queue.get_mergeable(key)
+        if not item:
+            item = {"key": key, "member": after, "added": {}, "removed": {}}
+            await queue.put_mergeable(key, item)
+
+        item["member"] = after
+        for role in added_roles:
+            if item["removed"].pop(role.id, None) is None:  # Removed then added again cancels out
+                item["added"][role.id] = role
+        for role in removed_roles:
+            if item["added"].pop(role.id, None) is None:
+                item["removed"][role.id] = role
+
+    def render_log(self, item: dict) -> Optional[Embed]:
+        if "embed" in item:
+            return item["embed"]
+
+        member = item["member"]
+        props = self.role_fields(list(item["added"].values()), list(item["removed"].values()))
+        if not props["fields"]:
+            return None  # Changes cancelled each other out
+
+        log = Embed(title=":information_source: Roles Updated", color=Colour.from_rgb(214, 174, 50))
+        log.add_field(name="User", value=f"{member} ({member.id})", inline=True)
+        for field in props["fields"]:
+            log.add_field(name=field["name"], value=field["value"])
+        log.set_thumbnail(url=get_user_avatar_url(member, mode=1)[0])
+        log.set_footer(text=self.bot.correct_time().strftime(self.bot.ts_format))
+        return log
+
+    def is_repeat_invite_log(self, fingerprint: int) -> bool:
+        """
+        Returns whether an invite log with this fingerprint was sent recently, remembering it if not.
+        Only the last `recent_invite_logs_size` fingerprints from the last `recent_invite_logs_ttl` seconds are kept.
+        """
+
+        now = time.monotonic()
+        while self.recent_invite_logs and next(iter(self.recent_invite_logs.values())) < now - self.recent_invite_logs_ttl:
+            self.recent_invite_logs.popitem(last=False)
+
+        if fingerprint in self.recent_invite_logs:
+            return True
+
+        self.recent_invite_logs[fingerprint] = now
+        if len(self.recent_invite_logs) > self.recent_invite_logs_size:
+            self.recent_invite_logs.popitem(last=False)
+        return False
+
+    async def cog_unload(self) -> None:
+        await self.message_store.close()
+
     @commands.Cog.listener()
     async def on_ready(self) -> None:
+        config = self.bot.cog_handler.give_config(self) or {}
+        self.batch_window_seconds = config.get("batch_window_seconds", self.batch_window_seconds)
+        self.max_pending_logs = config.get("max_pending_logs", self.max_pending_logs)
+        if not self.message_store_configured:  # on_ready fires again on reconnects, which mustn't throw away what's stored
+            store_config = config.get("message_store", {})
+            store = MessageStore(memory_size=store_config.get("memory_size", 5000), spill_path=store_config.get("spill_path", None) or None, spill_size=store_config.get("spill_size", 100000))
+            for message_id, message in self.message_store.memory.items():
+                store.put(message_id, message)
+            self.message_store, self.message_store_configured = store, True
+
         self.guilds = self.bot.guilds
         for guild in self.guilds:
-            self.invites[guild.id] = await self.get_all_invites(guild)
+            await self.load_invites(guild)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild: discord.Guild) -> None:
-        self.invites[guild.id] = await self.get_all_invites(guild)
+        await self.load_invites(guild)
+
+    @commands.Cog.listener()
+    async def on_invite_create(self, invite: discord.Invite) -> None:
+        if invite.guild:
+            self.invites.setdefault(invite.guild.id, {})[invite.code] = invite
+
+    @commands.Cog.listener()
+    async def on_invite_delete(self, invite: discord.Invite) -> None:
+        if invite.guild:
+            self.invites.get(invite.guild.id, {}).pop(invite.code, None)
+
+    @staticmethod
+    def store_message(message: discord.Message) -> StoredMessage:
+        return StoredMessage(message.channel.id, message.author.id, str(message.author), message.content, message.reference.message_id if message.reference else None)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message) -> None:
+        if message.guild:
+            self.message_store.put(message.id, self.store_message(message))
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message) -> None:
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        """
+        Uses the message store rather than discord.py's message cache, so deletes of older messages get logged too
+        """
 
-        ctx = await self.bot.get_context(message)  # needed to fetch ref message
+        stored = await self.message_store.pop(payload.message_id)
+        if not stored and payload.cached_message:
+            stored = self.store_message(payload.cached_message)
+        if not stored or not payload.guild_id:
+            return  # Nothing known about the message
 
-        channel = await self.get_log_channel(ctx, "message")
-        if channel is None or (message.author.id == self.bot.user.id and not message.content):  # Don't log in the logs if logs dont exist or bot deleting own embed pages
+        guild = self.bot.get_guild(payload.guild_id)
+        channel = await self.get_log_channel(guild, "message")
+        if channel is None or (stored.author_id == self.bot.user.id and not stored.content):  # Don't log in the logs if logs dont exist or bot deleting own embed pages
             return
 
+        message_channel = self.bot.get_channel(stored.channel_id)
         embeds = []
-        chunks = ceil(len(message.content)/1024)
+        chunks = ceil(len(stored.content)/1024)
 
         for i in range(1, chunks + 1):
             embed = Embed(title=":information_source: Message Deleted", color=Colour.from_rgb(172, 32, 31))
-            embed.add_field(name="User", value=f"{str(message.author)} ({message.author.id})" or "undetected", inline=True)
-            embed.add_field(name="Message ID", value=message.id, inline=True)
-            embed.add_field(name="Channel", value=message.channel.mention, inline=True)
-            embed.add_field(name=f"Message {f'part {i}' if i > 1 else ''}", value=message.content[1024*(i - 1):1024*i] if (hasattr(message, "content") and message.content) else "(No detected text content)", inline=False)
+            embed.add_field(name="User", value=f"{stored.author_name} ({stored.author_id})" or "undetected", inline=True)
+            embed.add_field(name="Message ID", value=payload.message_id, inline=True)
+            embed.add_field(name="Channel", value=message_channel.mention if message_channel else stored.channel_id, inline=True)
+            embed.add_field(name=f"Message {f'part {i}' if i > 1 else ''}", value=stored.content[1024*(i - 1):1024*i] if stored.content else "(No detected text content)", inline=False)
             embed.set_footer(text=self.bot.correct_time().strftime(self.bot.ts_format))
 
             embeds.append(embed)
 
-        [await channel.send(embed=embed) for embed in embeds]
+        [await self.send_log(channel, embed) for embed in embeds]
 
-        if message.reference:  # intended mainly for replies, can be used in other contexts (see docs)
-            ref = await ctx.fetch_message(message.reference.message_id)
+        if stored.reference_id:  # intended mainly for replies, can be used in other contexts (see docs)
+            ref = await self.message_store.get(stored.reference_id)  # No need to fetch it if it's stored
+            ref_channel_id = ref.channel_id if ref else stored.channel_id
+            ref_channel = self.bot.get_channel(ref_channel_id)
             reference = Embed(title=":arrow_upper_left: Reference of deleted message", color=Colour.from_rgb(172, 32, 31))
-            reference.add_field(name="Author of reference", value=f"{str(ref.author)} ({ref.author.id})", inline=True)
-            reference.add_field(name="Message ID", value=ref.id, inline=True)
-            reference.add_field(name="Channel", value=ref.channel.mention, inline=True)
-            reference.add_field(name="Jump Link", value=ref.jump_url)
+            reference.add_field(name="Author of reference", value=f"{ref.author_name} ({ref.author_id})" if ref else "(Not known)", inline=True)
+            reference.add_field(name="Message ID", value=stored.reference_id, inline=True)
+            reference.add_field(name="Channel", value=ref_channel.mention if ref_channel else ref_channel_id, inline=True)
+            reference.add_field(name="Jump Link", value=f"https://discord.com/channels/{payload.guild_id}/{ref_channel_id}/{stored.reference_id}")
 
-            await channel.send(embed=reference)
+            await self.send_log(channel, reference)
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
@@ -70,6 +394,8 @@ class Logging(commands.Cog):
         Logs bulk message deletes, such as those used in `purge` command
         """
         msg_channel = self.bot.get_channel(payload.channel_id)
+        for message_id in payload.message_ids:
+            await self.message_store.pop(message_id)
 
         channel = await self.get_log_channel(payload.guild_id, "message")
         if channel is None:
@@ -79,24 +405,35 @@ class Logging(commands.Cog):
         embed.add_field(name="Count", value=f"{len(payload.message_ids)}", inline=True)
         embed.add_field(name="Channel", value=msg_channel.mention, inline=True)
         embed.set_footer(text=self.bot.correct_time().strftime(self.bot.ts_format))
-        await channel.send(embed=embed)
+        await self.send_log(channel, embed)
 
     @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message) -> None:
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
         """
-        Could perhaps switch to on_raw_message_edit in the future? bot will only log what it can detect
-        based off its own caches
-        Same issue with on_message_delete
+        Uses the message store rather than discord.py's message cache for the old content, so edits of older messages get logged too
         """
 
-        if before.content == after.content:  # fixes weird bug where messages get logged as updated e.g. when an image or embed is posted, even though there's no actual change to their content
+        if "content" not in payload.data or not payload.guild_id:
+            return  # Not a content edit e.g. an embed got added
+
+        stored = await self.message_store.get(payload.message_id)
+        if not stored and payload.cached_message:
+            stored = self.store_message(payload.cached_message)
+        after_content = payload.data["content"]
+        if stored:
+            self.message_store.put(payload.message_id, stored._replace(content=after_content))
+
+        if not stored or stored.content == after_content:  # fixes weird bug where messages get logged as updated e.g. when an image or embed is posted, even though there's no actual change to their content
             return
 
-        channel = await self.get_log_channel(before.guild, "message")
+        channel = await self.get_log_channel(self.bot.get_guild(payload.guild_id), "message")
 
         if channel is None:
             return
 
+        message_channel = self.bot.get_channel(payload.channel_id)
+        before, after = stored, stored._replace(content=after_content)
+
         old_chunks = ceil(len(before.content)/1024)
         new_chunks = ceil(len(after.content)/1024)
         chunks = old_chunks if old_chunks > new_chunks else new_chunks
@@ -105,9 +442,9 @@ class Logging(commands.Cog):
 
         for i in range(1, chunks + 1):
             embed = Embed(title=":information_source: Message Updated", color=Colour.from_rgb(118, 37, 171))
-            embed.add_field(name="User", value=f"{str(after.author)} ({after.author.id})", inline=True)
-            embed.add_field(name="Message ID", value=after.id, inline=True)
-            embed.add_field(name="Channel", value=after.channel.mention, inline=True)
+            embed.add_field(name="User", value=f"{after.author_name} ({after.author_id})", inline=True)
+            embed.add_field(name="Message ID", value=payload.message_id, inline=True)
+            embed.add_field(name="Channel", value=message_channel.mention if message_channel else payload.channel_id, inline=True)
 
             if 1024*(i - 1) < len(before.content) or (not before.content and i == 1):
                 embed.add_field(name=f"Old Message {f'part {i}' if i > 1 else ''}", value=before.content[1024*(i - 1):1024*i] if before.content else "(No detected text content)", inline=False)
@@ -118,7 +455,7 @@ class Logging(commands.Cog):
 
             embeds.append(embed)
 
-        [await channel.send(embed=embed) for embed in embeds]
+        [await self.send_log(channel, embed) for embed in embeds]
 
     @staticmethod
     async def role_comparison(before: discord.Member, after: discord.Member) -> tuple[list[discord.Role], list[discord.Role]]:
@@ -137,18 +474,26 @@ class Logging(commands.Cog):
     async def embed_role_comparison(self, before: discord.Member, after: discord.Member) -> dict:
         """
         Expects before and after as Member objects
-        Worth noting that this and role_comparison will be of more use if role change logging aggregation is ever possible
         """
 
         removed_roles, added_roles = await self.role_comparison(before, after)
-        props = {"fields": []}
-        if added_roles:
-            value = "".join([f":white_check_mark: {role.mention} ({role.name})\n" for role in added_roles])
-            props["fields"].append({"name": "Added Roles", "value": value})
+        return self.role_fields(added_roles, removed_roles)
 
-        if removed_roles:
-            value = "".join([f":x: {role.mention} ({role.name})\n" for role in removed_roles])
-            props["fields"].append({"name": "Removed Roles", "value": value})
+    @staticmethod
+    def role_fields(added_roles: list[discord.Role], removed_roles: list[discord.Role]) -> dict:
+        props = {"fields": []}
+        for name, emoji, roles in [("Added Roles", ":white_check_mark:", added_roles), ("Removed Roles", ":x:", removed_roles)]:
+            if not roles:
+                continue
+
+            value = ""
+            for i, role in enumerate(roles):
+                line = f"{emoji} {role.mention} ({role.name})\n"
+                if len(value) + len(line) > 1000:  # Embed field values are capped at 1024 characters
+                    value += f"(+{len(roles) - i} roles)"
+                    break
+                value += line
+            props["fields"].append({"name": name, "value": value})
 
         return props
 
@@ -173,10 +518,6 @@ class Logging(commands.Cog):
         return {"fields": [{"name": "Old Nickname", "value": before.display_name},
                            {"name": "New Nickname", "value": after.display_name}]}
 
-    # todo: see if there's some way of aggregating groups of changes
-    # for example, multiple role changes shouldn't spam the log channel
-    # perhaps some weird stuff with task loops can do it??
-
     async def prop_change_handler(self, before: discord.Member, after: discord.Member) -> dict:
         """
         God handler which handles all the default logging embed behaviour
@@ -226,6 +567,12 @@ class Logging(commands.Cog):
             if hasattr(before, prop["name"]) and hasattr(after, prop["name"]):  # user objects don't have all the same properties as member objects
 
                 if (getattr(before, prop["name"]) != getattr(after, prop["name"])) or (prop["name"] == "avatar" and get_user_avatar_url(before)[0] != get_user_avatar_url(after)[0]):  # TODO: Fix up the edge case with avatars?
+                    if prop["name"] == "roles":  # Role changes are merged per member while they wait to be sent, see send_role_change
+                        channel = await self.get_log_channel(before.guild, "member_update")
+                        if channel:
+                            await self.send_role_change(channel, before, after)
+                        continue
+
                     log = Embed(title=f":information_source: {prop['display_name']} Updated", color=prop["colour"])
                     log.add_field(name="User", value=f"{after} ({after.id})", inline=True)
 
@@ -262,14 +609,14 @@ class Logging(commands.Cog):
                     if prop["display_name"] in ["Nickname", "Roles"]:
                         channel = await self.get_log_channel(before.guild, "member_update")
                         if channel:
-                            await channel.send(embed=log)
+                            await self.send_log(channel, log)
 
                     else:
                         shared_guilds = [x for x in self.bot.guilds if after in x.members]
                         for guild in shared_guilds:
                             channel = await self.get_log_channel(guild, "member_update")
                             if channel:
-                                await channel.send(embed=log)
+                                await self.send_log(channel, log)
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
@@ -313,7 +660,7 @@ class Logging(commands.Cog):
 
         member_left.set_thumbnail(url=get_user_avatar_url(member, mode=1)[0])
         member_left.set_footer(text=self.bot.correct_time().strftime(self.bot.ts_format))
-        await channel.send(embed=member_left)
+        await self.send_log(channel, member_left)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member) -> None:
@@ -323,25 +670,12 @@ class Logging(commands.Cog):
         if ichannel is None:  # If invite channel not set
             return
 
-        old_invites = self.invites[guild.id]
-        new_invites = await self.get_all_invites(guild)
-
-        updated_invites = []
-        # possible_joins_missed = False
-        for invite in new_invites:
-            found = False
-            for old_invite in old_invites:
-                if old_invite.code == invite.code:
-                    found = True
-                    if invite.uses > old_invite.uses:
-                        updated_invites.append(invite)
-                        # if invite.uses - old_invite.uses != 1:
-                        #     possible_joins_missed = True
-
-            if not found and invite.uses != 0:  # else 0-use invites will be logged
-                updated_invites.append(invite)  # new invites
-
-        self.invites[guild.id] = new_invites
+        invites_failed = False
+        try:
+            updated_invites = await self.get_used_invites(member)
+        except Exception as e:
+            print(f"Could not work out which invite {member} joined {guild} with\n{type(e).__name__}: {e}")
+            updated_invites, invites_failed = [], True
         if ichannel:  # still check & update invites in case channel is configured later
             invite_log = Embed(title="Invite data", color=Colour.from_rgb(0, 0, 255))
             if len(updated_invites) == 1:
@@ -370,17 +704,17 @@ class Logging(commands.Cog):
             invite_log.add_field(name="Account created", value=self.bot.correct_time(member.created_at).strftime(self.bot.ts_format), inline=False)
 
             if not updated_invites:
-                invite_log.add_field(name="Invite used", value="Server Discovery")
+                invite_log.add_field(name="Invite used", value="Unknown (the invites couldn't be fetched)" if invites_failed else "Server Discovery")
 
             invite_log.set_thumbnail(url=get_user_avatar_url(member, mode=1)[0])
             invite_log.set_footer(text=self.bot.correct_time().strftime(self.bot.ts_format))
-            if (invite_log.to_dict() not in self.previous_inv_log_embeds) or not updated_invites:  # limits log spam e.g. if connection drops
+            fingerprint = hash((guild.id, member.id, tuple(sorted([(invite.code, invite.uses) for invite in updated_invites]))))
+            if not updated_invites or not self.is_repeat_invite_log(fingerprint):  # limits log spam e.g. if connection drops
 
                 # if possible_joins_missed or len(updated_invites) != 1:
                 #    await get(guild.text_channels, name="invite-logs").send("*WARNING: Due to a bot glitch or other reason, the below data may be inaccurate due to potentially missed previous joins.*")
 
-                self.previous_inv_log_embeds.append(invite_log.to_dict())
-                await ichannel.send(embed=invite_log)
+                await self.send_log(ichannel, invite_log)
 
 
 async def setup(bot) -> None:
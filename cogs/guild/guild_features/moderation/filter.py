@@ -7,11 +7,100 @@ from libs.misc.decorators import is_staff
 import asyncio
 import ast  # using ast for literal_eval, stops code injection
 import asyncpg
+from collections import deque
+
+
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton built over a guild's filtered and ignored phrases.
+    Built once whenever the lists change, then reused so each message is scanned in a single pass regardless of how many phrases there are.
+    """
+
+    def __init__(self, filtered: list[str], ignored: list[str]) -> None:
+        self.filtered = [phrase.lower() for phrase in filtered]
+        self.goto = [{}]  # node -> {char: node}
+        self.fail = [0]
+        self.outputs = [[]]  # node -> [(is_filtered, index, length)] for phrases ending at this node
+
+        for index, phrase in enumerate(self.filtered):
+            self._insert(phrase, (True, index, len(phrase)))
+        for index, phrase in enumerate([phrase.lower() for phrase in ignored]):
+            self._insert(phrase, (False, index, len(phrase)))
+        self._build_links()
+
+    def _insert(self, phrase: str, output: tuple[bool, int, int]) -> None:
+        if not phrase:
+            return
+
+        node = 0
+        for char in phrase:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = nxt
+        self.outputs[node].append(output)
+
+    def _build_links(self) -> None:
+        """
+        Breadth-first pass that sets the failure links, merging each node's outputs with those of its failure node
+        """
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def tripped(self, text: str) -> list[str]:
+        """
+        Returns the filtered phrases found in `text` (in filter list order), ignoring any that overlap an occurrence of an ignored phrase
+        """
+
+        if not self.filtered:
+            return []
+
+        text = text.lower()
+        candidates = []
+        masked = [0] * (len(text) + 1)  # difference array of ignored spans
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for is_filtered, index, length in self.outputs[node]:
+                if is_filtered:
+                    candidates.append((position + 1 - length, position + 1, index))
+                else:
+                    masked[position + 1 - length] += 1
+                    masked[position + 1] -= 1
+
+        if not candidates:
+            return []
+
+        # prefix[i] = number of masked characters in text[:i], so any overlap with an ignored span is an O(1) lookup
+        prefix = [0] * (len(text) + 1)
+        depth = 0
+        for i in range(len(text)):
+            depth += masked[i]
+            prefix[i + 1] = prefix[i] + (depth > 0)
+
+        found = {index for start, end, index in candidates if prefix[end] == prefix[start]}
+        return [self.filtered[index] for index in sorted(found)]
 
 
 class Filter(commands.Cog):
     def __init__(self, bot) -> None:
         self.filters = {}
+        self.matchers = {}  # guild_id -> PhraseMatcher, rebuilt whenever that guild's lists change
         self.bot = bot
 
     async def check_is_command(self, message: discord.Message) -> bool:
@@ -19,16 +108,10 @@ class Filter(commands.Cog):
         Checks whether or not `message` is a valid filter command or not
         """
 
-        ctx = await self.bot.get_context(message)
-        content = message.content
-        prefixes = await self.bot.get_used_prefixes(message)
-        prefixes.sort(key=len, reverse=True)
-        for prefix in prefixes:
-            if content.startswith(prefix):
-                content = content.replace(prefix, "")
-                break
+        info = await self.bot.get_message_info(message)
+        content = message.content[len(info["prefix"]):] if info["prefix"] else message.content
 
-        is_command = True if (await self.bot.is_staff(ctx) and content.startswith("filter") and content != message.content) else False
+        is_command = True if (info["is_staff"] and content.startswith("filter") and content != message.content) else False
 
         return is_command
 
@@ -51,11 +134,21 @@ class Filter(commands.Cog):
                 else:
                     self.filters[guild.id] = prop
 
+        self.compile_filter(guild.id)
+
+    def compile_filter(self, guild_id: int) -> None:
+        """
+        Method used to (re)build the phrase matcher for a guild from its current filter lists
+        """
+
+        self.matchers[guild_id] = PhraseMatcher(self.filters[guild_id]["filtered"], self.filters[guild_id]["ignored"])
+
     async def propagate_new_guild_filter(self, guild: discord.Guild) -> None:
         """
         Method used for pushing filter changes to the DB
         """
 
+        self.compile_filter(guild.id)
         async with self.bot.pool.acquire() as connection:
             await connection.execute("UPDATE filter SET filters = $1 WHERE guild_id = $2", str(self.filters[guild.id]), guild.id)
 
@@ -101,18 +194,13 @@ class Filter(commands.Cog):
         Checks whether a message should be removed.
         """
 
-        ctx = await self.bot.get_context(message)
+        ctx = (await self.bot.get_message_info(message))["ctx"]
         is_command = await self.check_is_command(message)
         if not is_command and message.author.id == self.bot.user.id and message.reference:
             is_command = await self.check_is_command(await ctx.fetch_message(message.reference.message_id))
 
         try:
-            filters = self.filters[message.guild.id]
-            msg = message.content.lower()
-            for ignore in filters["ignored"]:
-                msg = msg.replace(ignore.lower(), "")
-
-            tripped = [phrase.lower() for phrase in filters["filtered"] if phrase.lower() in msg]
+            tripped = self.matchers[message.guild.id].tripped(message.content)
             disp_tripped = "||" + (" ,".join([f"'{trip}'" for trip in tripped[:10]])) + (f"(+ {len(tripped) - 10} more)" if len(tripped) > 10 else "") + "||"
             if tripped and not is_command:
                 # case insensitive is probably the best idea
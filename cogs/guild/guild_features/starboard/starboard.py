@@ -1,9 +1,12 @@
+from collections import OrderedDict
 from typing import Optional
 
 import discord
 from discord.ext import commands
 import asyncio
 import re
+import time
+from datetime import datetime, timedelta
 from emoji import get_emoji_regexp
 from libs.misc.decorators import is_staff
 from libs.misc.utils import get_user_avatar_url, get_guild_icon_url
@@ -11,27 +14,80 @@ from libs.misc.utils import get_user_avatar_url, get_guild_icon_url
 
 class Starboard:
     class Entry:
-        @classmethod
-        async def make_entry(cls, record: dict, bot: discord.Client) -> None:
-            super().__init__(cls)
-            self = Starboard.Entry()
+        """
+        Only the IDs are kept, the bot message itself is fetched the first time it's needed and then kept in a small LRU shared by all entries
+        """
+
+        hydrated = OrderedDict()  # Links bot_message_id -> discord.Message, least recently used first
+        max_hydrated = 256
+
+        def __init__(self, record: dict, bot: discord.Client) -> None:
             self.bot = bot
             self.bot_message_id = record["bot_message_id"]
             self.message_id = record["message_id"]
             self.channel_id = record["starboard_channel_id"]  # Channel ID of bot message
+            self.source_channel_id = record.get("source_channel_id", None)  # Channel ID of the starred message
+            self.author_id = record.get("author_id", None)
+            self.stars = record.get("stars", 0)
+
+        @property
+        def channel(self) -> Optional[discord.TextChannel | discord.Thread]:
+            return self.bot.get_channel(self.channel_id)
+
+        @classmethod
+        def remember(cls, message: discord.Message) -> None:
+            cls.hydrated[message.id] = message
+            cls.hydrated.move_to_end(message.id)
+            if len(cls.hydrated) > cls.max_hydrated:
+                cls.hydrated.popitem(last=False)
+
+        def forget_bot_message(self) -> None:
+            self.hydrated.pop(self.bot_message_id, None)
+
+        async def get_bot_message(self) -> Optional[discord.Message]:
+            """
+            Returns the bot message for this entry, or None if it no longer exists
+            """
+
+            message = self.hydrated.get(self.bot_message_id, None)
+            if message:
+                self.hydrated.move_to_end(self.bot_message_id)
+                return message
+
+            if not self.channel:
+                return None
+            try:
+                message = await self.channel.fetch_message(self.bot_message_id)
+            except discord.NotFound:
+                return None
+            self.remember(message)
+            return message
+
+        async def delete_bot_message(self) -> None:
+            """
+            Deletes the bot message without needing to fetch it first
+            """
+
+            self.forget_bot_message()
+            if not self.channel:
+                return
             try:
-                self.channel = bot.get_channel(self.channel_id)
-                self.bot_message = await self.channel.fetch_message(self.bot_message_id)
+                await self.channel.get_partial_message(self.bot_message_id).delete()
             except discord.NotFound:
-                self.channel = self.bot_message = None
-            return self
+                pass
 
         async def update_bot_message(self, new_msg: discord.Message) -> None:
-            self.bot_message = new_msg
+            self.forget_bot_message()
+            self.remember(new_msg)
             self.bot_message_id = new_msg.id
             async with self.bot.pool.acquire() as connection:
                 await connection.execute("UPDATE starboard_entry SET bot_message_id = $1 WHERE starboard_channel_id = $2 AND message_id = $3;", self.bot_message_id, self.channel_id, self.message_id)
 
+        async def update_stars(self, stars: int) -> None:
+            self.stars = stars
+            async with self.bot.pool.acquire() as connection:
+                await connection.execute("UPDATE starboard_entry SET stars = $1, updated_at = now() WHERE starboard_channel_id = $2 AND message_id = $3;", stars, self.channel_id, self.message_id)
+
     def __init__(self, record: dict, bot: discord.Client) -> None:
         self.bot = bot
         self.channel = self.bot.get_channel(record["channel_id"])
@@ -42,7 +98,7 @@ class Starboard:
         self.embed_colour = record["embed_colour"]
         self.allow_self_star = record["allow_self_star"]
         self.record = record
-        self.entries = []
+        self.entries = {}  # Links message_id -> Entry
 
     @classmethod
     async def make_starboards(cls, records: list, entries: list, bot: discord.Client) -> dict:
@@ -55,8 +111,8 @@ class Starboard:
             obj = Starboard(record, bot)
             starboards[obj.channel.id] = obj  # Make empty starboard
         for entry in entries:
-            obj = await Starboard.Entry.make_entry(entry, bot)
-            starboards[entry["starboard_channel_id"]].entries.append(obj)  # Add all entries to their respective starboard
+            obj = Starboard.Entry(entry, bot)  # Bot messages are only fetched when they're first needed
+            starboards[entry["starboard_channel_id"]].entries[entry["message_id"]] = obj  # Add all entries to their respective starboard
         return starboards
 
     def get_record(self) -> dict:
@@ -92,23 +148,23 @@ class Starboard:
         Returns either a starboard entry or None if it doesn't exist
         """
 
-        for entry in self.entries:
-            if entry.message_id == message_id:
-                return entry
-        return None
+        return self.entries.get(message_id, None)
 
-    async def create_entry(self, message_id: int, bot_message_id: int, starboard_channel_id: int, bot: discord.Client) -> None:
+    async def create_entry(self, message_id: int, bot_message_id: int, starboard_channel_id: int, bot: discord.Client, stars: int = 0, author_id: int = None, source_channel_id: int = None) -> None:
         """
         Creates a starboard entry for an existing starboard (adds to the DB too)
         """
 
         async with self.bot.pool.acquire() as connection:
-            await connection.execute("INSERT INTO starboard_entry (message_id, starboard_channel_id, bot_message_id) VALUES ($1, $2, $3);", message_id, self.channel.id, bot_message_id)
-        self.entries.append(await self.Entry.make_entry({
+            await connection.execute("INSERT INTO starboard_entry (message_id, starboard_channel_id, bot_message_id, stars, author_id, source_channel_id) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (starboard_channel_id, message_id) DO NOTHING;", message_id, self.channel.id, bot_message_id, stars, author_id, source_channel_id)
+        self.entries[message_id] = self.Entry({
             "message_id": message_id,
             "bot_message_id": bot_message_id,
-            "starboard_channel_id": starboard_channel_id
-        }, bot))
+            "starboard_channel_id": starboard_channel_id,
+            "source_channel_id": source_channel_id,
+            "author_id": author_id,
+            "stars": stars
+        }, bot)
 
     async def delete_entry(self, message_id: int) -> None:
         """
@@ -117,18 +173,26 @@ class Starboard:
 
         async with self.bot.pool.acquire() as connection:
             await connection.execute("DELETE FROM starboard_entry WHERE starboard_channel_id = $1 AND message_id = $2;", self.channel.id, message_id)
-        indx = -1
-        for i, e in enumerate(self.entries):  # TODO: What happens if found_entry is still None after search i.e. entry not found
-            if e.message_id == message_id:
-                indx = i
-                break
-        self.entries.pop(indx)
+        entry = self.entries.pop(message_id, None)
+        if entry:
+            entry.forget_bot_message()
 
 
 class StarboardCog(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
         self.starboards = {}  # Links channel_id -> Starboard
+        self.guild_starboards = {}  # Links guild_id -> {channel_id: Starboard}, so reaction events don't have to look through every guild's starboards
+        self.star_counts = OrderedDict()  # Links message_id -> {emoji: star counts}, least recently reacted first, see _update_star_counts
+        self.reconciling = {}  # Links (message_id, emoji) -> future of the star counts being fetched, so concurrent events share one fetch
+        self.reconcile_seconds = 600
+        self.tracked_messages = 5000
+        self.pending_updates = {}  # Links (starboard channel_id, message_id) -> latest update wanted for that entry, see _queue_update
+        self.update_workers = {}  # Links (starboard channel_id, message_id) -> {"task": applying that entry's updates in order, "wakeup": set to cut a debounce short}
+        self.edit_debounce_seconds = 5
+        self.backfill_chunk = 500
+        self.backfill_pause_seconds = 5
+        self.loaded = False  # on_ready fires again on reconnects, but the starboards only need loading once
 
     # TODO: Some help commands when args are missing would be nice
 
@@ -138,7 +202,7 @@ class StarboardCog(commands.Cog):
         Turns the message into an Embed that can be sent in the starboard channel
         """
 
-        embed = discord.Embed(title=f"{stars} {emoji} (in #{message.channel.name})", color=color if color else self.bot.GOLDEN_YELLOW, description=message.content)
+        embed = discord.Embed(title=self.star_title(stars, emoji, message.channel), color=color if color else self.bot.GOLDEN_YELLOW, description=message.content)
         embed.set_author(name=message.author.display_name, icon_url=get_user_avatar_url(message.author, mode=1)[0])
         if message.embeds:
             embedded_data = message.embeds[0]
@@ -147,7 +211,7 @@ class StarboardCog(commands.Cog):
             else:
                 embed.add_field(name="Message is an embed", value="Press the message link to view", inline=False)
 
-        if message.reference:
+        if message.reference and isinstance(message.reference.resolved, discord.Message):
             embed.add_field(name="In response to...", value=f"{message.reference.resolved.author.display_name}#{message.reference.resolved.author.discriminator}", inline=False)
 
         if message.attachments:
@@ -164,6 +228,120 @@ class StarboardCog(commands.Cog):
         embed.set_footer(text=self.bot.correct_time().strftime("%H:%M on %m/%d/%Y"))
         return embed
 
+    @staticmethod
+    def star_title(stars: int, emoji: discord.Emoji | discord.PartialEmoji | str, channel: discord.TextChannel | discord.Thread) -> str:
+        return f"{stars} {emoji}" + (f" (in #{channel.name})" if channel else "")
+
+    # --- Star counts ---
+
+    @staticmethod
+    def _emoji_key(emoji: discord.Emoji | discord.PartialEmoji | str) -> int | str:
+        return emoji if type(emoji) is str else (emoji.id or emoji.name)
+
+    @staticmethod
+    def _is_starboard_emoji(starboard: Starboard, emoji: discord.PartialEmoji) -> bool:
+        return (starboard.emoji is not None and starboard.emoji == emoji.name) or (starboard.emoji_id is not None and starboard.emoji_id == emoji.id)
+
+    async def _fetch_message(self, payload) -> Optional[discord.Message]:
+        channel = self.bot.get_channel(payload.channel_id)
+        try:
+            return await channel.fetch_message(payload.message_id) if channel else None
+        except discord.NotFound:
+            return None
+
+    def _find_reaction(self, message: discord.Message, emoji: discord.PartialEmoji) -> Optional[discord.Reaction]:
+        return next((r for r in message.reactions if self._emoji_key(r.emoji) == self._emoji_key(emoji)), None)
+
+    async def _reconcile_star_counts(self, payload) -> Optional[dict]:
+        """
+        (Re)seeds the star counts for the reacted message and emoji from Discord, returns None if the message no longer exists.
+        Events that come in while a reconcile for the same message and emoji is running share it, so a burst of stars on a new post costs one fetch.
+        """
+
+        key = (payload.message_id, self._emoji_key(payload.emoji))
+        if key not in self.reconciling:
+            self.reconciling[key] = asyncio.ensure_future(self._fetch_star_counts(payload))
+            self.reconciling[key].add_done_callback(lambda future: self.reconciling.pop(key, None))
+        return await asyncio.shield(self.reconciling[key])
+
+    async def _fetch_star_counts(self, payload) -> Optional[dict]:
+        """
+        Seeds the star counts from a single fetch of the message.
+
+        Only this bot's own reaction can be left out from the reaction count alone, so the reactors are only gone through (by _get_stars)
+        when a starboard doesn't allow self stars and the count is high enough for it to matter.
+        """
+
+        message = await self._fetch_message(payload)
+        if not message:
+            self.star_counts.pop(payload.message_id, None)
+            return None
+
+        reaction = self._find_reaction(message, payload.emoji)
+        return self._track_star_counts(payload, {
+            "stars": reaction.count - reaction.me if reaction else 0,  # Never count this bot's own reaction
+            "author_id": message.author.id,
+            "self_starred": None if reaction else False,  # None means not known
+            "reconciled_at": time.monotonic(),
+            "message": message  # Only kept until the events waiting on this fetch have been handled
+        })
+
+    def _track_star_counts(self, payload, counts: dict) -> dict:
+        self.star_counts.setdefault(payload.message_id, {})[self._emoji_key(payload.emoji)] = counts
+        self.star_counts.move_to_end(payload.message_id)
+        while len(self.star_counts) > self.tracked_messages:
+            self.star_counts.popitem(last=False)
+        return counts
+
+    async def _scan_star_counts(self, counts: dict, payload) -> None:
+        """
+        Recounts the stars exactly by going through everyone who reacted, leaving out bots, and works out whether the author starred their own message
+        """
+
+        message = counts.get("message") or await self._fetch_message(payload)
+        reaction = self._find_reaction(message, payload.emoji) if message else None
+        users = [u async for u in reaction.users()] if reaction else []
+        counts["stars"] = len([u for u in users if not u.bot])
+        counts["self_starred"] = counts["author_id"] in [u.id for u in users]
+        counts["reconciled_at"] = time.monotonic()
+
+    async def _update_star_counts(self, payload, starboards: list[Starboard]) -> Optional[dict]:
+        """
+        Applies a raw reaction event to the star counts of the message and emoji it's for, only going to Discord if they aren't known or are stale.
+        Messages already on one of the `starboards` start from the count and author stored in the DB instead.
+        Returns None if the message no longer exists.
+        """
+
+        counts = self.star_counts.get(payload.message_id, {}).get(self._emoji_key(payload.emoji), None)
+        if counts is None:
+            # Only entries on starboards that allow self stars store the count as it is, the others have had the author's own star taken off already
+            entry = next((e for e in [starboard.entries.get(payload.message_id, None) for starboard in starboards if starboard.allow_self_star] if e and e.author_id is not None), None)
+            if entry:
+                counts = self._track_star_counts(payload, {"stars": entry.stars, "author_id": entry.author_id, "self_starred": None, "reconciled_at": time.monotonic()})
+
+        if counts is None or time.monotonic() - counts["reconciled_at"] > self.reconcile_seconds:
+            return await self._reconcile_star_counts(payload)  # Already includes this reaction
+
+        self.star_counts.move_to_end(payload.message_id)
+        user = payload.member or self.bot.get_user(payload.user_id)
+        if user and user.bot:
+            return counts
+
+        added = payload.event_type == "REACTION_ADD"
+        counts["stars"] = max(counts["stars"] + (1 if added else -1), 0)
+        if payload.user_id == counts["author_id"]:
+            counts["self_starred"] = added
+        return counts
+
+    async def _get_stars(self, starboard: Starboard, counts: dict, payload) -> int:
+        """
+        Returns how many stars count towards `starboard`
+        """
+
+        if not starboard.allow_self_star and counts["self_starred"] is None and counts["stars"] >= starboard.minimum_stars:
+            await self._scan_star_counts(counts, payload)  # Whether the author's own star gets taken off decides whether the minimum is met
+        return counts["stars"] - (1 if not starboard.allow_self_star and counts["self_starred"] else 0)
+
     # --- Utility functions ---
 
     async def _get_starboards(self, guild_id: int) -> list:
@@ -171,11 +349,18 @@ class StarboardCog(commands.Cog):
         Returns all a list of Starboard for a given guild
         """
 
-        results = []
-        for starboard in self.starboards.values():
-            if starboard.guild.id == guild_id:
-                results.append(starboard)
-        return results
+        return list(self.guild_starboards.get(guild_id, {}).values())
+
+    def _index_starboard(self, starboard: Starboard) -> None:
+        self.starboards[starboard.channel.id] = starboard
+        self.guild_starboards.setdefault(starboard.guild.id, {})[starboard.channel.id] = starboard
+
+    def _unindex_starboard(self, channel_id: int) -> None:
+        starboard = self.starboards.pop(channel_id)
+        guild_starboards = self.guild_starboards.get(starboard.guild.id, {})
+        guild_starboards.pop(channel_id, None)
+        if not guild_starboards:
+            self.guild_starboards.pop(starboard.guild.id, None)
 
     async def _try_get_starboard(self, channel_id: int) -> Optional[Starboard]:
         """
@@ -202,15 +387,15 @@ class StarboardCog(commands.Cog):
             "minimum_stars": minimum_stars,
             "embed_colour": embed_colour,
             "allow_self_star": allow_self_star
-        })
-        self.starboards[channel.id] = new_starboard
+        }, self.bot)
+        self._index_starboard(new_starboard)
 
     async def _delete_starboard(self, channel: discord.TextChannel | discord.Thread) -> None:
         """
         Deletes a starboard channel and all its entries from the database
         """
 
-        del self.starboards[channel.id]  # Remove from starboards
+        self._unindex_starboard(channel.id)  # Remove from starboards
         async with self.bot.pool.acquire() as connection:
             await connection.execute("DELETE FROM starboard WHERE channel_id = $1;", channel.id)
 
@@ -268,6 +453,112 @@ class StarboardCog(commands.Cog):
         except asyncio.TimeoutError:
             return None
 
+    # --- Backfill ---
+
+    async def handle_backfill(self, data: dict) -> None:
+        """
+        Runs one chunk of a starboard backfill, then schedules the next chunk after a pause so that other work (and Discord's rate limits) get a look in.
+        Progress is kept in `starboard_backfill` after every few entries, so a backfill carries on from where it got to after a restart.
+        """
+
+        async with self.bot.pool.acquire() as connection:
+            job = await connection.fetchrow("SELECT * FROM starboard_backfill WHERE id = $1;", data["starboard_backfill_id"])
+        if not job or job["finished"]:
+            return
+
+        starboard = self.starboards.get(job["starboard_channel_id"], None)
+        channel = self.bot.get_channel(job["source_channel_id"])
+        if not starboard or not channel:
+            await self._finish_backfill(job["id"], "Backfill stopped, the starboard or channel no longer exists.")
+            return
+
+        try:
+            finished = await self._backfill_chunk(job, starboard, channel)
+        except discord.Forbidden:
+            await self._finish_backfill(job["id"], f"Backfill stopped, I can't read the history of {channel.mention}.")
+            return
+
+        if finished:
+            await self._finish_backfill(job["id"])
+        else:
+            await self.bot.tasks.submit_task("starboard_backfill", datetime.utcnow() + timedelta(seconds=self.backfill_pause_seconds), extra_columns={"starboard_backfill_id": job["id"]})
+
+    async def _backfill_chunk(self, job: dict, starboard: Starboard, channel: discord.TextChannel | discord.Thread) -> bool:
+        """
+        Streams up to `backfill_chunk` messages after the job's cursor, oldest first, and puts the ones with enough stars on the starboard.
+        Returns whether the end of the window was reached.
+        """
+
+        after = discord.Object(id=job["cursor_message_id"]) if job["cursor_message_id"] else job["after_time"]
+        starboard_emoji = starboard.emoji_id or starboard.emoji
+        pending, cursor, scanned, chunk_scanned = [], job["cursor_message_id"], 0, 0  # scanned is since progress was last saved
+        async for message in channel.history(limit=self.backfill_chunk, after=after, before=job["before_time"], oldest_first=True):
+            scanned += 1
+            chunk_scanned += 1
+            cursor = message.id
+            if message.id in starboard.entries:
+                continue
+
+            reaction = next((r for r in message.reactions if self._emoji_key(r.emoji) == starboard_emoji), None)
+            stars = reaction.count - reaction.me if reaction else 0
+            if stars < starboard.minimum_stars:
+                continue
+            # Only messages that might make it get their reactors gone through, so bots (and the author's own star, if it doesn't count) are left out like on the live path
+            users = [u async for u in reaction.users()]
+            stars = len([u for u in users if not u.bot and (starboard.allow_self_star or u.id != message.author.id)])
+            if stars < starboard.minimum_stars:
+                continue
+
+            msg = await starboard.channel.send(embed=await self.make_starboard_embed(message, stars, reaction.emoji, self._get_colour(starboard)))
+            # Known straight away so a live reaction before the next save edits this post rather than making another
+            starboard.entries[message.id] = starboard.Entry({
+                "message_id": message.id,
+                "bot_message_id": msg.id,
+                "starboard_channel_id": starboard.channel.id,
+                "source_channel_id": message.channel.id,
+                "author_id": message.author.id,
+                "stars": stars
+            }, self.bot)
+            starboard.Entry.remember(msg)
+            pending.append(message.id)
+            if len(pending) >= 10:  # Save every few entries so a restart doesn't post them again
+                await self._save_backfill(job["id"], starboard, pending, cursor, scanned)
+                pending, scanned = [], 0
+
+        progress = await self._save_backfill(job["id"], starboard, pending, cursor, scanned)
+        up_to = self.bot.correct_time(discord.utils.snowflake_time(cursor)).strftime(self.bot.ts_format) if cursor else "the start"
+        await self._report_backfill(progress, f"Backfilling {starboard.channel.mention} from {channel.mention}: {progress['scanned']} messages looked at, {progress['added']} added so far (up to {up_to})...")
+        return chunk_scanned < self.backfill_chunk
+
+    async def _save_backfill(self, job_id: int, starboard: Starboard, pending: list[int], cursor: Optional[int], scanned: int) -> dict:
+        """
+        Adds the entries made so far (by message ID) and moves the job's cursor along, in one transaction. Returns the job's updated record.
+        The entries are saved as they are now, so live reactions since they were posted are kept and ones that have since come off the starboard are skipped
+        """
+
+        entries = [starboard.entries[message_id] for message_id in pending if message_id in starboard.entries]
+        rows = [(entry.message_id, entry.channel_id, entry.bot_message_id, entry.stars, entry.author_id, entry.source_channel_id) for entry in entries]
+        async with self.bot.pool.acquire() as connection:
+            async with connection.transaction():
+                if rows:
+                    await connection.executemany("INSERT INTO starboard_entry (message_id, starboard_channel_id, bot_message_id, stars, author_id, source_channel_id) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (starboard_channel_id, message_id) DO NOTHING;", rows)
+                job = await connection.fetchrow("UPDATE starboard_backfill SET cursor_message_id = $2, scanned = scanned + $3, added = added + $4 WHERE id = $1 RETURNING *;", job_id, cursor, scanned, len(rows))
+        return job
+
+    async def _finish_backfill(self, job_id: int, reason: str = None) -> None:
+        async with self.bot.pool.acquire() as connection:
+            job = await connection.fetchrow("UPDATE starboard_backfill SET finished = true WHERE id = $1 RETURNING *;", job_id)
+        await self._report_backfill(job, reason if reason else f"Backfill finished! {job['scanned']} messages looked at, {job['added']} added to the starboard.")
+
+    async def _report_backfill(self, job: dict, content: str) -> None:
+        channel = self.bot.get_channel(job["progress_channel_id"]) if job["progress_channel_id"] else None
+        if not channel:
+            return
+        try:
+            await channel.get_partial_message(job["progress_message_id"]).edit(content=content)
+        except discord.HTTPException:
+            pass  # Progress is only a nicety
+
     # --- Listeners ---
 
     @commands.Cog.listener()
@@ -278,64 +569,137 @@ class StarboardCog(commands.Cog):
     async def on_raw_reaction_remove(self, payload) -> None:
         await self.on_raw_reaction_event(payload)
     
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload) -> None:
+        self.star_counts.pop(payload.message_id, None)  # Recounted on the next reaction
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload) -> None:
+        self.star_counts.get(payload.message_id, {}).pop(self._emoji_key(payload.emoji), None)
+
     async def on_raw_reaction_event(self, payload) -> None:
-        try:
-            message = await self.bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
-        except discord.NotFound:
+        starboards = [starboard for starboard in await self._get_starboards(payload.guild_id)
+                      if payload.channel_id != starboard.channel.id and self._is_starboard_emoji(starboard, payload.emoji)]  # stops people spamming star react onto starboard embeds
+        if not starboards:
+            return  # Nothing to do, don't bother fetching the message
+
+        counts = await self._update_star_counts(payload, starboards)
+        if not counts:
             return
 
-        starboards = await self._get_starboards(payload.guild_id)
         for starboard in starboards:
-            if message.channel.id == starboard.channel.id:  # stops people spamming star react onto starboard embeds
-                continue
+            # Stars are counted from the reaction events as they come in rather than fetched every time, see _update_star_counts
+            stars = await self._get_stars(starboard, counts, payload)
+            self._queue_update(starboard, payload, stars, counts.get("message", None))
 
-            # Parse the colour if one exists
-            if starboard.embed_colour:
-                colour = starboard.embed_colour  # colour is now a hex code in the format "#FFFFFF"
-                r = int(colour[1] + colour[2], 16)
-                g = int(colour[3] + colour[4], 16)
-                b = int(colour[5] + colour[6], 16)
-                colour = discord.Color.from_rgb(r, g, b)
-            else:
-                colour = self.bot.GOLDEN_YELLOW
-
-            if (starboard.emoji is not None and starboard.emoji == payload.emoji.name) or (starboard.emoji_id is not None and starboard.emoji_id == payload.emoji.id):  # Valid emoji
-                # Get the amount of stars (we fetch this from Discord instead of having a field in starboard_entry record because new emoji's may be added when bot is offline)
-                # Find the correct reaction
-                stars = 0
-                for r in message.reactions:
-                    if (not r.is_custom_emoji() and r.emoji == payload.emoji.name) or (r.is_custom_emoji() and r.emoji.id == payload.emoji.id):
-                        # This is the reaction we want to process
-                        stars = r.count
-                        # If the starboard has self star disabled, we need to remove a star if the author has reacted, as well as all stars from a bot
-                        deducted_stars = [u.id for u in await r.users().flatten() if u.bot or (not starboard.allow_self_star and u.id == message.author.id)]  # Means that bots cannot star nor the author IF allow self star is False
-                        stars -= len(deducted_stars)
-                
-                minimum_met = stars >= starboard.minimum_stars
-                entry = await starboard.try_get_entry(payload.message_id)
-                if not minimum_met:
-                    if entry:
-                        await starboard.delete_entry(payload.message_id)
-                        if entry.bot_message:
-                            await entry.bot_message.delete()
-                            
-                elif entry and entry.bot_message:  # If minimum met and entry
-                    new_embed = await self.make_starboard_embed(message, stars, payload.emoji, colour)
+        counts.pop("message", None)
+
+    # --- Starboard updates ---
+
+    def _queue_update(self, starboard: Starboard, payload, stars: int, message: discord.Message = None) -> None:
+        """
+        Records the latest star count for a message on a starboard, and makes sure a worker is applying it.
+        Only the latest update for each entry is kept, so a burst of reactions ends up as a single edit.
+        """
+
+        key = (starboard.channel.id, payload.message_id)
+        previous = self.pending_updates.get(key, {})
+        self.pending_updates[key] = {"starboard": starboard, "payload": payload, "stars": stars, "message": message or previous.get("message", None)}
+        if key not in self.update_workers:
+            self.update_workers[key] = {"wakeup": asyncio.Event()}
+            self.update_workers[key]["task"] = asyncio.create_task(self._run_updates(key))
+        elif stars < starboard.minimum_stars:
+            self.update_workers[key]["wakeup"].set()  # Coming off the starboard shouldn't wait for a debounce
+
+    async def _run_updates(self, key: tuple[int, int]) -> None:
+        """
+        Applies the updates for one entry one at a time, so they can never be applied out of order.
+
+        Updates that only change the count of an entry already on the starboard wait `edit_debounce_seconds` for the burst to finish first.
+        Updates that put a message on or take it off the starboard are applied straight away (cutting a debounce short), so those transitions are never delayed or lost.
+        """
+
+        debounced = False
+        wakeup = self.update_workers[key]["wakeup"]
+        try:
+            while key in self.pending_updates:
+                update = self.pending_updates[key]
+                starboard = update["starboard"]
+                entry = await starboard.try_get_entry(key[1])
+                if entry and update["stars"] >= starboard.minimum_stars and not debounced:
+                    debounced = True
+                    wakeup.clear()
                     try:
-                        # Update bot message
-                        await entry.bot_message.edit(embed=new_embed)
-                    except discord.NotFound:
-                        # Bot message deleted
-                        msg = await starboard.channel.send(embed=new_embed)
-                        await entry.update_bot_message(msg)
-                else:
-                    message = await self.bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
-                    # Message doesn't exist, make a new one
-                    msg = await starboard.channel.send(embed=await self.make_starboard_embed(message, stars, payload.emoji, colour))
-                    if not entry:
-                        await starboard.create_entry(payload.message_id, msg.id, starboard.channel.id, self.bot)
-                    elif entry or entry.bot_message is None:
-                        await entry.update_bot_message(msg)
+                        await asyncio.wait_for(wakeup.wait(), timeout=self.edit_debounce_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue  # Look at whatever the latest update is now
+
+                debounced = False
+                del self.pending_updates[key]
+                try:
+                    await self._apply_update(update)
+                except discord.HTTPException as e:
+                    print(f"Couldn't update starboard entry {key[1]} in {key[0]}\n{type(e).__name__}: {e}")
+        finally:
+            self.update_workers.pop(key, None)
+
+    async def _apply_update(self, update: dict) -> None:
+        """
+        Makes the starboard entry for the message match the update, creating, editing or deleting the bot message as needed
+        """
+
+        payload, stars = update["payload"], update["stars"]
+        starboard = self.starboards.get(update["starboard"].channel.id, None)  # Looked up again in case it was edited or deleted while the update was waiting
+        if not starboard:
+            return
+
+        entry = await starboard.try_get_entry(payload.message_id)
+        if stars < starboard.minimum_stars:
+            if entry:
+                await starboard.delete_entry(payload.message_id)
+                await entry.delete_bot_message()
+            return
+
+        bot_message = await entry.get_bot_message() if entry else None
+        if bot_message and bot_message.embeds:  # If minimum met and entry, only the count in the title needs changing
+            new_embed = bot_message.embeds[0]
+            channel = self.bot.get_channel(payload.channel_id) or (update["message"].channel if update["message"] else None)
+            if not channel:
+                try:
+                    channel = await self.bot.fetch_channel(payload.channel_id)
+                except discord.HTTPException:
+                    pass  # Title just goes without the channel
+            new_embed.title = self.star_title(stars, payload.emoji, channel)
+            try:
+                # Update bot message
+                entry.remember(await bot_message.edit(embed=new_embed))
+                await entry.update_stars(stars)
+                return
+            except discord.NotFound:
+                pass  # Bot message deleted, make a new one below
+
+        # Bot message doesn't exist, make a new one
+        message = update["message"] or await self._fetch_message(payload)
+        if not message:
+            return
+        msg = await starboard.channel.send(embed=await self.make_starboard_embed(message, stars, payload.emoji, self._get_colour(starboard)))
+        if not entry:
+            await starboard.create_entry(payload.message_id, msg.id, starboard.channel.id, self.bot, stars=stars, author_id=message.author.id, source_channel_id=message.channel.id)
+            starboard.Entry.remember(msg)
+        else:
+            await entry.update_bot_message(msg)
+            await entry.update_stars(stars)
+
+    def _get_colour(self, starboard: Starboard) -> discord.Color:
+        # Parse the colour if one exists
+        if starboard.embed_colour:
+            colour = starboard.embed_colour  # colour is now a hex code in the format "#FFFFFF"
+            r = int(colour[1] + colour[2], 16)
+            g = int(colour[3] + colour[4], 16)
+            b = int(colour[5] + colour[6], 16)
+            return discord.Color.from_rgb(r, g, b)
+        return self.bot.GOLDEN_YELLOW
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel: discord.TextChannel | discord.Thread) -> None:
@@ -348,10 +712,35 @@ class StarboardCog(commands.Cog):
         while not self.bot.online:
             await asyncio.sleep(1)  # Wait else DB won't be available
 
+        config = self.bot.cog_handler.give_config(self) or {}
+        self.reconcile_seconds = config.get("reconcile_seconds", self.reconcile_seconds)
+        self.tracked_messages = config.get("tracked_messages", self.tracked_messages)
+        self.edit_debounce_seconds = config.get("edit_debounce_seconds", self.edit_debounce_seconds)
+        self.backfill_chunk = config.get("backfill_chunk", self.backfill_chunk)
+        self.backfill_pause_seconds = config.get("backfill_pause_seconds", self.backfill_pause_seconds)
+        if self.loaded:
+            return
+        self.loaded = True
+
         async with self.bot.pool.acquire() as connection:
+            if not await connection.fetchval("SELECT to_regclass('starboard_entry_message_key');"):
+                async with connection.transaction():
+                    # Each message can only be on a starboard once, drop any duplicates (keeping the latest) before making that a constraint
+                    await connection.execute("DELETE FROM starboard_entry a USING starboard_entry b WHERE a.starboard_channel_id = b.starboard_channel_id AND a.message_id = b.message_id AND a.ctid < b.ctid;")
+                    await connection.execute("CREATE UNIQUE INDEX starboard_entry_message_key ON starboard_entry (starboard_channel_id, message_id);")
+                    await connection.execute("DROP INDEX IF EXISTS starboard_entry_message_idx;")  # The non-unique one it replaces
+            await connection.execute("CREATE INDEX IF NOT EXISTS starboard_entry_stars_idx ON starboard_entry (starboard_channel_id, stars DESC);")
+            await connection.execute("CREATE INDEX IF NOT EXISTS starboard_entry_author_idx ON starboard_entry (starboard_channel_id, author_id);")
             starboards = await connection.fetch("SELECT * FROM starboard;")
             entries = await connection.fetch("SELECT * FROM starboard_entry;")
-            self.starboards = await Starboard.make_starboards(starboards, entries, self.bot)
+            self.starboards, self.guild_starboards = {}, {}
+            for starboard in (await Starboard.make_starboards(starboards, entries, self.bot)).values():
+                self._index_starboard(starboard)
+
+            await self.bot.tasks.register_task_type("starboard_backfill", self.handle_backfill, needs_extra_columns={"starboard_backfill_id": "int"})
+            orphaned = await connection.fetch("SELECT id FROM starboard_backfill WHERE NOT finished AND id NOT IN (SELECT starboard_backfill_id FROM tasks WHERE starboard_backfill_id IS NOT NULL);")
+        for job in orphaned:  # The task for a chunk was lost (e.g. it errored), carry on from where it got to
+            await self.bot.tasks.submit_task("starboard_backfill", datetime.utcnow(), extra_columns={"starboard_backfill_id": job["id"]})
             
     # --- Commands ---
 
@@ -385,6 +774,94 @@ class StarboardCog(commands.Cog):
         await embed.set_page(1)
         await embed.send()
 
+    async def _get_starboard_ids(self, ctx: commands.Context, channel: Optional[discord.TextChannel | discord.Thread]) -> Optional[list[int]]:
+        """
+        Returns the channel IDs of the starboards to look at, either just `channel`'s or all of the guild's. Returns None (after saying so) if there aren't any
+        """
+
+        if channel and not await self._try_get_starboard(channel.id):
+            await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "Starboard does not exist")
+            return None
+
+        channel_ids = [channel.id] if channel else [starboard.channel.id for starboard in await self._get_starboards(ctx.guild.id)]
+        if not channel_ids:
+            await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "This server has no starboards")
+            return None
+        return channel_ids
+
+    @starboard.command()
+    @commands.guild_only()
+    async def top(self, ctx: commands.Context, channel: discord.TextChannel | discord.Thread = None) -> None:
+        """
+        View the most starred messages on the server's starboards, or only on `channel`'s starboard if given
+        """
+
+        channel_ids = await self._get_starboard_ids(ctx, channel)
+        if not channel_ids:
+            return
+
+        async with self.bot.pool.acquire() as connection:
+            rows = await connection.fetch("SELECT message_id, starboard_channel_id, source_channel_id, author_id, stars FROM starboard_entry WHERE starboard_channel_id = ANY($1::bigint[]) ORDER BY stars DESC LIMIT 10;", channel_ids)
+
+        if not rows:
+            await self.bot.DefaultEmbedResponses.information_embed(self.bot, ctx, "No messages have been starred yet")
+            return
+
+        desc = ""
+        for i, row in enumerate(rows):
+            emoji = self.starboards[row["starboard_channel_id"]].get_string_emoji()
+            author = f"<@{row['author_id']}>" if row["author_id"] else "*Unknown*"
+            link = f"[Jump](https://discord.com/channels/{ctx.guild.id}/{row['source_channel_id']}/{row['message_id']})" if row["source_channel_id"] else f"Message {row['message_id']}"
+            desc += f"**{i + 1}.** {row['stars']} {emoji} by {author} - {link}\n"
+        await self.bot.DefaultEmbedResponses.information_embed(self.bot, ctx, f"Most starred messages in {ctx.guild.name}", desc=desc)
+
+    @starboard.command()
+    @commands.guild_only()
+    async def stats(self, ctx: commands.Context, channel: discord.TextChannel | discord.Thread = None) -> None:
+        """
+        View statistics for the server's starboards, or only for `channel`'s starboard if given
+        """
+
+        channel_ids = await self._get_starboard_ids(ctx, channel)
+        if not channel_ids:
+            return
+
+        async with self.bot.pool.acquire() as connection:
+            totals = await connection.fetchrow("SELECT COUNT(*) AS entries, COALESCE(SUM(stars), 0) AS stars, COUNT(DISTINCT author_id) AS authors, MAX(created_at) AS latest FROM starboard_entry WHERE starboard_channel_id = ANY($1::bigint[]);", channel_ids)
+            authors = await connection.fetch("SELECT author_id, COUNT(*) AS entries, SUM(stars) AS stars FROM starboard_entry WHERE starboard_channel_id = ANY($1::bigint[]) AND author_id IS NOT NULL GROUP BY author_id ORDER BY stars DESC LIMIT 5;", channel_ids)
+
+        desc = f"• Messages on the starboard: {totals['entries']}\n"
+        desc += f"• Total stars: {totals['stars']}\n"
+        desc += f"• Different authors: {totals['authors']}\n"
+        if totals["latest"]:
+            desc += f"• Last message added: {self.bot.correct_time(totals['latest']).strftime(self.bot.ts_format)}\n"
+        if authors:
+            desc += "\n**Most starred authors**\n" + "\n".join([f"**{i + 1}.** <@{row['author_id']}> - {row['stars']} stars across {row['entries']} message{'s' if row['entries'] != 1 else ''}" for i, row in enumerate(authors)])
+        await self.bot.DefaultEmbedResponses.information_embed(self.bot, ctx, f"{ctx.guild.name}'s starboard stats", desc=desc)
+
+    @starboard.command()
+    @commands.guild_only()
+    @is_staff()
+    async def backfill(self, ctx: commands.Context, starboard_channel: discord.TextChannel | discord.Thread, channel: discord.TextChannel | discord.Thread, days: int = 30) -> None:
+        """
+        Put messages from the last `days` days of `channel` that already have enough stars onto `starboard_channel`'s starboard.
+        This runs in the background, progress is shown by editing the message sent in reply.
+        """
+
+        starboard = await self._try_get_starboard(starboard_channel.id)
+        if not starboard:
+            await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "Starboard does not exist")
+            return
+        if days <= 0:
+            await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "Invalid number of days given - it must be above 0")
+            return
+
+        progress = await ctx.send(f"Starting to backfill {starboard_channel.mention} from the last {days} day{'s' if days != 1 else ''} of {channel.mention}...")
+        now = discord.utils.utcnow()
+        async with self.bot.pool.acquire() as connection:
+            job_id = await connection.fetchval("INSERT INTO starboard_backfill (starboard_channel_id, source_channel_id, after_time, before_time, progress_channel_id, progress_message_id) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id;", starboard_channel.id, channel.id, now - timedelta(days=days), now, ctx.channel.id, progress.id)
+        await self.bot.tasks.submit_task("starboard_backfill", datetime.utcnow(), extra_columns={"starboard_backfill_id": job_id})
+
     @starboard.command()
     @commands.guild_only()
     @is_staff()
@@ -1,7 +1,9 @@
+import asyncio
+
 import discord
 from discord.ext import commands
 from discord import Embed, Colour
-import matplotlib.pyplot as plt
+from libs.misc.charts import line_chart
 from libs.misc.decorators import is_staff
 from libs.misc.utils import get_user_avatar_url, get_guild_icon_url
 
@@ -9,18 +11,102 @@ from libs.misc.utils import get_user_avatar_url, get_guild_icon_url
 class Reputation(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
+        self.write_behind_seconds = 0
+        self.pending_reps = {}  # Links (guild_id, member_id) -> {"change": int, "result": future of the new total}, see modify_rep
+        self.flusher = None
+        self.migrated = asyncio.Event()  # Set once the unique index the upserts rely on exists, commands wait for it, see on_ready
+        self.departed = {}  # Links guild_id -> set of member IDs with rep rows who are no longer in the guild, see get_departed
+
+    @commands.Cog.listener()
+    async def on_ready(self) -> None:
+        while not self.bot.online:
+            await asyncio.sleep(1)  # Wait else DB won't be available
+
+        config = self.bot.cog_handler.give_config(self) or {}
+        self.write_behind_seconds = config.get("write_behind_seconds", self.write_behind_seconds)
+
+        if self.migrated.is_set():
+            return  # on_ready fires again on reconnects
+
+        try:
+            async with self.bot.pool.acquire() as connection:
+                if not await connection.fetchval("SELECT to_regclass('rep_guild_member_idx');"):
+                    async with connection.transaction():
+                        # Older versions allowed NULL reps and could leave several rows for one member, keep the highest before making them unique
+                        await connection.execute("UPDATE rep SET reps = 0 WHERE reps IS NULL;")
+                        await connection.execute("DELETE FROM rep a USING rep b WHERE a.guild_id = b.guild_id AND a.member_id = b.member_id AND (COALESCE(a.reps, 0) < COALESCE(b.reps, 0) OR (COALESCE(a.reps, 0) = COALESCE(b.reps, 0) AND a.ctid < b.ctid));")
+                        await connection.execute("CREATE UNIQUE INDEX rep_guild_member_idx ON rep (guild_id, member_id);")
+                await connection.execute("CREATE INDEX IF NOT EXISTS rep_guild_reps_idx ON rep (guild_id, reps DESC, member_id DESC);")  # Ranking and leaderboard pages
+        except Exception as e:
+            print(f"Could not migrate the rep table, rep changes will fail until it is fixed\n{type(e).__name__}: {e}")
+        finally:
+            self.migrated.set()  # Don't leave commands waiting forever either way
+
+    async def cog_before_invoke(self, ctx: commands.Context) -> None:
+        await self.migrated.wait()  # Commands that race startup would otherwise hit ON CONFLICT before the unique index exists
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member) -> None:
+        if member.guild.id in self.departed:
+            self.departed[member.guild.id].add(member.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member) -> None:
+        if member.guild.id in self.departed:
+            self.departed[member.guild.id].discard(member.id)
+
+    async def get_departed(self, guild: discord.Guild) -> list[int]:
+        """
+        Returns the IDs of members with rep rows who have left the guild, so they can be left out of rankings.
+
+        The set is worked out once per guild from the member IDs alone and then kept up to date by the member join/remove listeners.
+        """
+
+        if guild.id not in self.departed:
+            async with self.bot.pool.acquire() as connection:
+                member_ids = await connection.fetch("SELECT member_id FROM rep WHERE guild_id = $1;", guild.id)
+            self.departed[guild.id] = {record["member_id"] for record in member_ids if guild.get_member(record["member_id"]) is None}
+        return list(self.departed[guild.id])
+
+    async def fetch_leaderboard_page(self, guild_id: int, departed: list[int], page_length: int, after: tuple = None, offset: int = 0) -> list:
+        """
+        Returns [member_id, reps, rank] for one page of the leaderboard, ordered by reps then member ID (both descending).
+
+        With `after` (the (reps, member_id) of the last row on the previous page) the page is found by seeking the index rather than counting
+        through `offset` rows. The ranks are dense, worked out within the page and then shifted by the number of distinct rep values above it.
+        """
+
+        seek = "AND (reps, member_id) < ($3, $4)" if after else ""
+        skip = "" if after else "OFFSET $3"
+        async with self.bot.pool.acquire() as connection:
+            return await connection.fetch(f"""WITH page AS (
+                                                  SELECT member_id, reps FROM rep WHERE guild_id = $1 AND member_id <> ALL($2::bigint[]) {seek}
+                                                  ORDER BY reps DESC, member_id DESC LIMIT {int(page_length)} {skip}
+                                              )
+                                              SELECT member_id, reps, DENSE_RANK() OVER (ORDER BY reps DESC)
+                                                     + (SELECT COUNT(DISTINCT reps) FROM rep WHERE guild_id = $1 AND member_id <> ALL($2::bigint[]) AND reps > (SELECT MAX(reps) FROM page)) AS rank
+                                              FROM page ORDER BY reps DESC, member_id DESC;""", guild_id, departed, *(after if after else (offset,)))
 
     async def get_leaderboard(self, ctx: commands.Context) -> None:
+        departed = await self.get_departed(ctx.guild)
         async with self.bot.pool.acquire() as connection:
-            leaderboard = await connection.fetch("SELECT member_id, reps FROM rep WHERE guild_id = $1 ORDER BY reps DESC", ctx.guild.id)
+            total = await connection.fetchval("SELECT COUNT(*) FROM rep WHERE guild_id = $1 AND member_id <> ALL($2::bigint[]);", ctx.guild.id, departed)
 
-        if len(leaderboard) == 0:
+        if total == 0:
             await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, f"There aren't any reputation points in {ctx.guild.name} yet! ")
             return
 
+        last_keys = {}  # Links page number -> (reps, member_id) of its last row, so the page after it can be seeked to
+
+        async def load_page(page_num: int, page_length: int) -> list:
+            rows = await self.fetch_leaderboard_page(ctx.guild.id, departed, page_length, after=last_keys.get(page_num - 1), offset=(page_num - 1) * page_length)
+            if rows:
+                last_keys[page_num] = (rows[-1]["reps"], rows[-1]["member_id"])
+            return rows
+
         embed = self.bot.EmbedPages(
             self.bot.PageTypes.REP,
-            leaderboard,
+            [],
             f"{ctx.guild.name}'s Reputation Leaderboard",
             Colour.from_rgb(177, 252, 129),
             self.bot,
@@ -28,38 +114,74 @@ class Reputation(commands.Cog):
             ctx.channel,
             thumbnail_url=get_guild_icon_url(ctx.guild),
             icon_url=get_user_avatar_url(ctx.author, mode=1)[0],
-            footer=f"Requested by: {ctx.author.display_name} ({ctx.author})\n" + self.bot.correct_time().strftime(self.bot.ts_format)
+            footer=f"Requested by: {ctx.author.display_name} ({ctx.author})\n" + self.bot.correct_time().strftime(self.bot.ts_format),
+            page_loader=load_page,
+            total=total
         )
         await embed.set_page(1)  # Default first page
         await embed.send()
 
     async def modify_rep(self, member: discord.Member, change: int) -> int:
-        async with self.bot.pool.acquire() as connection:
-            reps = await connection.fetchval("SELECT reps FROM rep WHERE member_id = ($1) AND guild_id = $2", member.id, member.guild.id)
-            if not reps:
-                await connection.execute("INSERT INTO rep (reps, member_id, guild_id) VALUES ($1, $2, $3)", change, member.id, member.guild.id)
-            else:
-                await self.set_rep(member.id, member.guild.id, reps+change)
-                reps = reps + change
-
-        return reps if reps else change
-    
+        """
+        Adds `change` to the member's reps in a single upsert and returns their new total.
+
+        If `write_behind_seconds` is set, changes are held for that long and all the changes made in the meantime are written in one statement,
+        with every change for the same member combined.
+        """
+
+        if not self.write_behind_seconds:
+            async with self.bot.pool.acquire() as connection:
+                return await connection.fetchval("INSERT INTO rep (guild_id, member_id, reps) VALUES ($1, $2, $3) ON CONFLICT (guild_id, member_id) DO UPDATE SET reps = rep.reps + EXCLUDED.reps RETURNING reps;", member.guild.id, member.id, change)
+
+        key = (member.guild.id, member.id)
+        pending = self.pending_reps.get(key, None)
+        if not pending:
+            pending = self.pending_reps[key] = {"change": 0, "result": asyncio.get_running_loop().create_future()}
+        pending["change"] += change
+        if not self.flusher or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_reps_later())
+        return await asyncio.shield(pending["result"])
+
+    async def flush_reps_later(self) -> None:
+        # Changes made while a flush is writing land in the fresh pending_reps, so keep going until nothing is left
+        while self.pending_reps:
+            await asyncio.sleep(self.write_behind_seconds)
+            await self.flush_reps()
+
+    async def flush_reps(self) -> None:
+        """
+        Writes all the held rep changes in one statement
+        """
+
+        pending, self.pending_reps = self.pending_reps, {}
+        if not pending:
+            return
+
+        try:
+            async with self.bot.pool.acquire() as connection:
+                results = await connection.fetch("INSERT INTO rep (guild_id, member_id, reps) SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::int[]) ON CONFLICT (guild_id, member_id) DO UPDATE SET reps = rep.reps + EXCLUDED.reps RETURNING guild_id, member_id, reps;",
+                                                 [key[0] for key in pending], [key[1] for key in pending], [change["change"] for change in pending.values()])
+        except Exception as e:
+            for change in pending.values():
+                change["result"].set_exception(e)
+            return
+
+        for result in results:
+            pending[(result["guild_id"], result["member_id"])]["result"].set_result(result["reps"])
+
     async def clear_rep(self, user_id: int, guild_id: int) -> None:
+        await self.flush_reps()  # So held changes don't land on top of the clear
         async with self.bot.pool.acquire() as connection:
             await connection.execute("DELETE FROM rep WHERE member_id = ($1) AND guild_id = $2", user_id, guild_id)
 
     async def set_rep(self, user_id: int, guild_id: int, reps: int) -> int:
+        if reps == 0:
+            await self.clear_rep(user_id, guild_id)
+            return 0
+
+        await self.flush_reps()
         async with self.bot.pool.acquire() as connection:
-            if reps == 0:
-                await self.clear_rep(user_id, guild_id)
-                return 0
-            else:
-                await connection.execute("UPDATE rep SET reps = ($1) WHERE member_id = ($2) AND guild_id = $3", reps, user_id, guild_id)
-                new_reps = await connection.fetchval("SELECT reps FROM rep WHERE member_id = ($1) AND guild_id = $2", user_id, guild_id)
-                if not new_reps:  # User was not already on the rep table, it needs adding
-                    await connection.execute("INSERT INTO rep (reps, member_id, guild_id) VALUES ($1, $2, $3)", reps, user_id, guild_id)
-                    new_reps = reps
-                return new_reps
+            return await connection.fetchval("INSERT INTO rep (guild_id, member_id, reps) VALUES ($1, $2, $3) ON CONFLICT (guild_id, member_id) DO UPDATE SET reps = EXCLUDED.reps RETURNING reps;", guild_id, user_id, reps)
 
 # -----------------------REP COMMANDS------------------------------
 
@@ -173,6 +295,7 @@ class Reputation(commands.Cog):
         Resets everyone's reps.
         """
 
+        await self.flush_reps()
         async with self.bot.pool.acquire() as connection:
             await connection.execute("DELETE from rep WHERE guild_id = $1", ctx.guild.id)
 
@@ -265,25 +388,14 @@ class Reputation(commands.Cog):
                 await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "We could not find that user!")
                 return
 
-        rep = None
-        lb_pos = None
+        departed = await self.get_departed(ctx.guild)
         async with self.bot.pool.acquire() as connection:
-            all_rep = await connection.fetch("SELECT member_id, reps FROM rep WHERE guild_id = $1 ORDER by reps DESC;", ctx.guild.id)
-            all_rep = [x for x in all_rep if ctx.channel.guild.get_member(x[0]) is not None]
-            member_record = next((x for x in all_rep if x[0] == user.id), None)
-            if member_record:  # If the user actually has reps
-                rep = member_record[1]  # Check member ID and then get reps
-                prev = 0
-                lb_pos = 0
-                for record in all_rep:
-                    if record[1] != prev:
-                        lb_pos += 1
-                        prev = record[1]  # Else, increase the rank
-                    if record[0] == user.id:
-                        break  # End loop if reached the user
-
-        if not rep:
-            rep = 0
+            # Dense rank, i.e. 1 + the number of distinct rep values above theirs
+            member_record = await connection.fetchrow("SELECT reps, (SELECT COUNT(DISTINCT reps) FROM rep WHERE guild_id = $1 AND member_id <> ALL($3::bigint[]) AND reps > r.reps) + 1 AS rank FROM rep r WHERE guild_id = $1 AND member_id = $2;",
+                                                      ctx.guild.id, user.id, departed)
+
+        rep = member_record["reps"] if member_record and user.id not in departed else 0
+        lb_pos = member_record["rank"] if rep else None
         embed = Embed(title=f"Rep info for {user.display_name} ({user})", color=Colour.from_rgb(139, 0, 139))
         # could change to user.colour at some point, I prefer the purple for now though
         embed.add_field(name="Rep points", value=rep)
@@ -298,13 +410,15 @@ class Reputation(commands.Cog):
         async with self.bot.pool.acquire() as connection:
             vals = await connection.fetch("SELECT DISTINCT reps, COUNT(member_id) FROM rep WHERE reps > 0 AND guild_id = $1 GROUP BY reps ORDER BY reps", ctx.guild.id)
 
-        fig, ax = plt.subplots()
-        ax.plot([x[0] for x in vals], [x[1] for x in vals], "b-o", linewidth=0.5, markersize=1)
-        ax.set(xlabel="Reputation points (rep)", ylabel="Frequency (reps)", title="Rep frequency graph")
-        ax.grid()
-        ax.set_ylim(bottom=0)
+        chart = {
+            "lines": [{"x": [x[0] for x in vals], "y": [x[1] for x in vals], "style": "b-o", "linewidth": 0.5, "markersize": 1}],
+            "xlabel": "Reputation points (rep)",
+            "ylabel": "Frequency (reps)",
+            "title": "Rep frequency graph"
+        }
+        image = await self.bot.charts.render(line_chart, chart, key=("rep-data", ctx.guild.id), version=repr(chart))  # What gets drawn, so every process agrees on when it needs redrawing
 
-        await self.bot.send_image_file(fig, ctx.channel, "rep-data")
+        await self.bot.send_image_file(image, ctx.channel, "rep-data")
 
 
 async def setup(bot) -> None:
@@ -65,7 +65,7 @@ class Member(commands.Cog):
         if type(message.channel) == discord.DMChannel or message.author.bot:
             return
 
-        if "bruh" in message.content.lower() and not message.author.bot and True not in [message.content.startswith(prefix) for prefix in await self.bot.get_used_prefixes(message)]:  # fix prefix detection
+        if "bruh" in message.content.lower() and not message.author.bot and (await self.bot.get_message_info(message))["prefix"] is None:
             async with self.bot.pool.acquire() as connection:
                 await connection.execute("UPDATE config SET bruhs=bruhs + 1 WHERE guild_id=($1)", message.guild.id)
         return
@@ -4,7 +4,10 @@ from enum import Enum
 import copy
 import asyncpg
 import asyncio
-from typing import Any
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+from libs.misc.decorators import is_dev
 from libs.misc.utils import get_guild_icon_url, get_user_avatar_url
 
 
@@ -20,15 +23,98 @@ def get_validator(value):
     return getattr(Validation, value)
 
 
+class ConfigCache:
+    """
+    Mapping of guild_id -> config dict with least recently used eviction once it holds more than `max_size` guilds, and optional expiry
+    of entries older than `ttl` seconds. Guilds that `is_pinned` returns True for (e.g. those with unwritten changes) are never dropped.
+    Lookups are O(1) and hits, misses and evictions are counted so the hit rate can be checked.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None, is_pinned: Callable[[int], bool] = lambda guild_id: False) -> None:
+        self.entries = OrderedDict()  # guild_id -> (config, time loaded), least recently used first
+        self.max_size = max_size
+        self.ttl = ttl
+        self.is_pinned = is_pinned
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_live(self, guild_id: int) -> bool:
+        """
+        Whether `guild_id` is cached and hasn't expired, dropping it if it has
+        """
+
+        entry = self.entries.get(guild_id)
+        if entry is None:
+            return False
+        if self.ttl and time.monotonic() - entry[1] > self.ttl and not self.is_pinned(guild_id):
+            del self.entries[guild_id]
+            return False
+        return True
+
+    def _evict(self) -> None:
+        while self.max_size is not None and len(self.entries) > self.max_size:
+            for guild_id in self.entries:  # oldest first
+                if not self.is_pinned(guild_id):
+                    break
+            else:
+                return  # everything left is pinned
+            del self.entries[guild_id]
+            self.evictions += 1
+
+    def resize(self, max_size: Optional[int], ttl: Optional[float]) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._evict()
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def get(self, guild_id: int, default: Any = None) -> Any:
+        if not self._is_live(guild_id):
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(guild_id)
+        return self.entries[guild_id][0]
+
+    def __getitem__(self, guild_id: int) -> dict:
+        if not self._is_live(guild_id):
+            raise KeyError(guild_id)
+        self.entries.move_to_end(guild_id)
+        return self.entries[guild_id][0]
+
+    def __setitem__(self, guild_id: int, config: dict) -> None:
+        self.entries[guild_id] = (config, time.monotonic())
+        self.entries.move_to_end(guild_id)
+        self._evict()
+
+    def __delitem__(self, guild_id: int) -> None:
+        del self.entries[guild_id]
+
+    def __contains__(self, guild_id: int) -> bool:
+        return self._is_live(guild_id)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+
 class Config(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
-        self.bot.configs = {}
+        self.dirty = {}  # guild_id -> keys changed in bot.configs that haven't been written to the DB yet
+        self.loading = {}  # guild_id -> config load in progress, so concurrent misses share one query
+        self.bot.configs = ConfigCache(is_pinned=lambda guild_id: guild_id in self.dirty)
         self.bot.config_cog = self
         self.bot.update_config = self.update_config
         self.bot.register_config_key = self.register_config_key
         self.bot.is_staff = self.is_staff  # is_staff defined here
         self.bot.get_config_key = self.get_config_key
+        self.columns = None  # cached column names of the config table, None when it needs fetching again
         self.CONFIG = {  # Stores each column of the config table, the type of validation it is, and a short description of how its used - the embed follows the same order as this
             "staff_role": [Validation.Role, "The role that designates bot perms"],  # CORE
             "log_channel": [Validation.Channel, "Where the main logs go"],  # CORE
@@ -40,12 +126,44 @@ class Config(commands.Cog):
             validator_type = getattr(Validation, validator_type, None)
 
         if [type(a) for a in [name, validator_type, description]] == [str, Validation, str]:
+            if name not in self.CONFIG:
+                self.columns = None  # new key may come with a new column, so the cached columns can't be trusted
             self.CONFIG[name] = [validator_type, description]
 
     async def add_all_guild_configs(self) -> None:
-        """Adds configs to all guilds - executed on startup"""
-        for guild in self.bot.guilds:
-            await self.add_config(guild.id)
+        """
+        Adds configs to all guilds - executed on startup. All the existing records are fetched in one query and any missing ones are
+        inserted in another, rather than going guild by guild. Only as many guilds as the cache can hold are loaded, the rest load when first used.
+        """
+
+        guild_ids = [guild.id for guild in self.bot.guilds if guild.id not in self.bot.configs]
+        if self.bot.configs.max_size is not None:
+            guild_ids = guild_ids[:max(self.bot.configs.max_size - len(self.bot.configs), 0)]
+        if not guild_ids:
+            return
+
+        async with self.bot.pool.acquire() as connection:
+            records = await connection.fetch("SELECT * FROM config WHERE guild_id = ANY($1::bigint[]);", guild_ids)
+            found = {record["guild_id"] for record in records}
+            missing = [guild_id for guild_id in guild_ids if guild_id not in found]
+            if missing:
+                records += await connection.fetch("INSERT INTO config (guild_id) SELECT unnest($1::bigint[]) ON CONFLICT DO NOTHING RETURNING *;", missing)
+                found = {record["guild_id"] for record in records}
+                missing = [guild_id for guild_id in missing if guild_id not in found]
+                if missing:  # inserted by something else in the meantime
+                    records += await connection.fetch("SELECT * FROM config WHERE guild_id = ANY($1::bigint[]);", missing)
+
+        for record in records:
+            self.bot.configs[record["guild_id"]] = self.make_config(record)
+
+    def make_config(self, record: asyncpg.Record) -> dict:
+        """
+        Turns a record from the `config` table into a config dictionary (column name = key, value = value), leaving out guild_id and any
+        phantom columns, and filling in None for keys that don't have a column yet
+        """
+
+        record = dict(record)
+        return {key: record.get(key, None) for key in self.CONFIG}
 
     async def is_staff(self, ctx: commands.Context) -> bool:
         """
@@ -62,6 +180,9 @@ class Config(commands.Cog):
         while not self.bot.online:
             await asyncio.sleep(1)  # Wait else DB won't be available
 
+        config = self.bot.cog_handler.give_config(self) or {}
+        cache = config.get("cache", {})
+        self.bot.configs.resize(cache.get("max_size") or None, cache.get("ttl_seconds") or None)
         await self.add_all_guild_configs()
 
     @commands.Cog.listener()
@@ -73,8 +194,8 @@ class Config(commands.Cog):
         await self.add_config(guild.id)
 
         # General configuration workflow:
-        # 1) Make any edits directly to bot.configs[guild.id]
-        # 2) Call bot.propagate_config(guild.id) which propagates any edits to the DB
+        # 1) Call bot.update_config(guild, key, value), which edits bot.configs[guild.id] and marks the key as dirty
+        # 2) Only the dirty keys are then propagated to the DB
 
     async def add_config(self, guild_id: int) -> None:
         """
@@ -82,7 +203,7 @@ class Config(commands.Cog):
         is stored in the `config` table. If no configuration is found, a new record is made and a blank configuration dict.
         """
 
-        if guild_id not in self.bot.configs:  # This check (to see if a DB call is needed) is okay because any updates made will be directly made to self.bot.configs (before DB propagation) TODO: Perhaps limit number of items in this
+        if guild_id not in self.bot.configs:  # This check (to see if a DB call is needed) is okay because any updates made will be directly made to self.bot.configs (before DB propagation), and guilds with unpropagated updates are never evicted
             async with self.bot.pool.acquire() as connection:
                 record = await connection.fetchrow("SELECT * FROM config WHERE guild_id = $1;", guild_id)
                 if not record:
@@ -94,83 +215,101 @@ class Config(commands.Cog):
                         record = await connection.fetchrow("SELECT * FROM config WHERE guild_id = $1;",
                                                            guild_id)  # Fetch configuration record
 
-            keys = list(record.keys())[1:]
-            values = list(record.values())[1:]  # Include all keys and values apart from the first one (guild_id)
+            self.bot.configs[guild_id] = self.make_config(record)
+
+    @staticmethod
+    def get_guild_id(ctx: commands.Context | discord.Guild | int) -> int:
+        if isinstance(ctx, discord.Guild):
+            return ctx.id
+        elif hasattr(ctx, "guild"):
+            return ctx.guild.id
+        return ctx
+
+    async def update_config(self, ctx: commands.Context | discord.Guild | int, key: str, value: Any) -> None:
+        """
+        Write-through update of a single config key. The key is marked as dirty and propagated to the DB straight away.
+        """
 
-            i = 0
-            while i < len(keys):  # remove phantom keys
-                if keys[i] not in self.CONFIG.keys():
-                    del keys[i]
-                    del values[i]
-                    i -= 1
-                i += 1
+        guild_id = self.get_guild_id(ctx)
+        config = await self.get_config(guild_id)
+        if config is None:
+            return
+
+        config[key] = value
+        self.dirty.setdefault(guild_id, set()).add(key)
+        await self.propagate_config(guild_id)
 
-            for key in self.CONFIG:
-                if key not in keys:
-                    keys.append(key)
-                    values.append(None)
+    async def get_config(self, ctx: commands.Context | discord.Guild | int) -> Optional[dict]:
+        """
+        Returns the config dict for a guild, loading it from the DB if it isn't cached (or has been evicted). None is returned if it
+        can't be loaded, e.g. the DB isn't available yet or the bot isn't in that guild.
+        """
 
-            self.bot.configs[guild_id] = dict(
-                zip(keys, values))  # Turns the record into a dictionary (column name = key, value = value)
+        guild_id = self.get_guild_id(ctx)
+        config = self.bot.configs.get(guild_id)
+        if config is not None or not self.bot.online or not self.bot.get_guild(guild_id):
+            return config
 
-    async def update_config(self, ctx: commands.Context, key: str, value: str) -> None:
-        if ctx.guild.id in self.bot.configs:
-            self.bot.configs[ctx.guild.id][key] = value
-            await self.propagate_config(ctx.guild.id)
+        if guild_id not in self.loading:
+            self.loading[guild_id] = asyncio.ensure_future(self.add_config(guild_id))
+            self.loading[guild_id].add_done_callback(lambda future: self.loading.pop(guild_id, None))
+        await asyncio.shield(self.loading[guild_id])
+        return self.bot.configs[guild_id] if guild_id in self.bot.configs else None
 
     async def get_config_key(self, ctx: commands.Context | discord.Guild | int, key: str) -> Any:
-        if isinstance(ctx, discord.Guild):
-            ctx_id = ctx.id
-        elif hasattr(ctx, "guild"):
-            ctx_id = ctx.guild.id
-        else:
-            ctx_id = ctx
-        return self.bot.configs.get(ctx_id, {}).get(key, None)
+        """
+        Returns a single config value, or None (the default for every key) if it isn't set or the config can't be loaded right now.
+        Used in hot paths like prefix lookups and message listeners, so a DB problem on a cache miss is logged rather than raised.
+        """
+
+        try:
+            config = await self.get_config(ctx)
+        except (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresError, asyncpg.exceptions.InterfaceError) as e:
+            print(f"Could not load the config for guild {self.get_guild_id(ctx)}, using defaults for '{key}'\n{type(e).__name__}: {e}")
+            config = None
+        return (config or {}).get(key, None)
 
     async def propagate_config(self, guild_id: int) -> None:
         """
-        Method that sends the config data stored in self.bot.configs and propagates them to the DB.
+        Method that sends the dirty config keys stored in self.bot.configs and propagates them to the DB in a single UPDATE.
         Should only be called internally ideally.
         """
 
-        async with self.bot.pool.acquire() as connection:
-            current_columns = await connection.fetch("SELECT column_name FROM information_schema.columns WHERE table_name = 'config'")
-            current_columns = [column["column_name"] for column in current_columns]
+        keys = self.dirty.pop(guild_id, set())
+        if not keys:
+            return
 
         data = self.bot.configs[guild_id]
-        new_data = {}
-        for j in data:
-            if data.get(j):
-                new_data[j] = data[j]
-
-        data = new_data
-        length = len(data.keys())
-
-        # Make SQL
-        sql_part = ""
-        keys = list(data)  # List of the keys (current column names in the database)
-        counter = 0
-        for i in range(length):
-            column_exists = keys[i] in list(current_columns)
-            if data.get(keys[i], None):
-                if not column_exists:  # create new columns when data needs to be stored
-                    async with self.bot.pool.acquire() as connection:
-                        validator = self.CONFIG.get(keys[i])[0]
+        try:
+            async with self.bot.pool.acquire() as connection:
+                if self.columns is None:
+                    current_columns = await connection.fetch("SELECT column_name FROM information_schema.columns WHERE table_name = 'config'")
+                    self.columns = {column["column_name"] for column in current_columns}
+
+                changed = []
+                for key in keys:
+                    if key not in self.columns:
+                        if not data.get(key):
+                            continue  # nothing to store and nothing stored before, so no column needed yet
+
+                        # create new columns when data needs to be stored
+                        validator = self.CONFIG.get(key)[0]
                         if validator in [Validation.Role, Validation.Channel, Validation.Integer]:
-                            await connection.execute(f"ALTER TABLE config ADD {keys[i]} BIGINT")
+                            await connection.execute(f"ALTER TABLE config ADD {key} BIGINT")
                         elif validator == Validation.Boolean:
-                            await connection.execute(f"ALTER TABLE config ADD {keys[i]} BOOLEAN DEFAULT false")
+                            await connection.execute(f"ALTER TABLE config ADD {key} BOOLEAN DEFAULT false")
                         else:
-                            await connection.execute(f"ALTER TABLE config ADD {keys[i]} VARCHAR(1023)")
-
-            if data.get(keys[i], None) or not data.get(keys[i], None) and column_exists:  # need to update table if column exists as there was already data
-                sql_part += f"{keys[i]} = (${counter + 1}),"  # For each key, add "{nth key_name} = $n+1"
-
-                counter += 1
-
-        sql = f"UPDATE config SET {sql_part[:-1]} WHERE guild_id = {guild_id};"
-        async with self.bot.pool.acquire() as connection:
-            await connection.execute(sql, *data.values())
+                            await connection.execute(f"ALTER TABLE config ADD {key} VARCHAR(1023)")
+                        self.columns.add(key)
+                    changed.append(key)
+
+                if changed:
+                    sql_part = ", ".join([f"{key} = (${i + 1})" for i, key in enumerate(changed)])  # For each key, add "{nth key_name} = $n+1"
+                    await connection.execute(f"UPDATE config SET {sql_part} WHERE guild_id = ${len(changed) + 1};", *[data[key] for key in changed], guild_id)
+        except Exception:
+            self.dirty.setdefault(guild_id, set()).update(keys)  # keep them dirty so the next propagation retries them
+            self.columns = None
+            raise
 
     # COMMANDS
     @commands.command()
@@ -198,7 +337,7 @@ class Config(commands.Cog):
             """
 
             data = copy.deepcopy(self.CONFIG)
-            config_dict = self.bot.configs[ctx.guild.id]
+            config_dict = await self.get_config(ctx)
 
             for key in config_dict.keys():
                 if key not in data.keys():
@@ -309,12 +448,10 @@ class Config(commands.Cog):
 
         # At this point, the input is valid and can be changed
         if validation_type == Validation.Channel or validation_type == Validation.Role:
-            self.bot.configs[ctx.guild.id][key] = value.id
-            await self.propagate_config(ctx.guild.id)
+            await self.update_config(ctx, key, value.id)
             await self.bot.DefaultEmbedResponses.success_embed(self.bot, ctx, f"{key} has been updated!", f"It has been changed to '{value.mention}'")  # Value is either a TextChannel, Thread or Role
         else:
-            self.bot.configs[ctx.guild.id][key] = value
-            await self.propagate_config(ctx.guild.id)
+            await self.update_config(ctx, key, value)
             await self.bot.DefaultEmbedResponses.success_embed(self.bot, ctx, f"{key} has been updated!", f"It has been changed to '{value}'")
 
     @config.command(pass_context=True)
@@ -333,8 +470,7 @@ class Config(commands.Cog):
             await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "That is not a valid configuration option!")
             return
 
-        self.bot.configs[ctx.guild.id][key] = None
-        await self.propagate_config(ctx.guild.id)
+        await self.update_config(ctx, key, None)
         await self.bot.DefaultEmbedResponses.success_embed(self.bot, ctx, f"{key} has been updated!", "It has been changed to ***N/A***")
 
     @config.command(pass_context=True)
@@ -352,7 +488,7 @@ class Config(commands.Cog):
             await ctx.invoke(self.bot.get_command("config"))
         else:
 
-            config_dict = self.bot.configs[ctx.guild.id]
+            config_dict = await self.get_config(ctx)
             key = key.lower()
             if key not in self.CONFIG.keys():
                 await self.bot.DefaultEmbedResponses.error_embed(self.bot, ctx, "That is not a valid configuration option!")
@@ -397,6 +533,21 @@ class Config(commands.Cog):
         else:
             await ctx.send("You are not staff!")
 
+    @commands.command(pass_context=True)
+    @is_dev()
+    async def configcache(self, ctx: commands.Context) -> None:
+        """
+        Shows how well the guild config cache is doing
+        """
+
+        cache = self.bot.configs
+        desc = f"• Guilds cached: {len(cache)}{f'/{cache.max_size}' if cache.max_size else ''}\n"
+        desc += f"• Expiry: {self.bot.time_str(cache.ttl) if cache.ttl else 'Never'}\n"
+        desc += f"• Hit rate: {cache.hit_rate:.2%} ({cache.hits} hits, {cache.misses} misses)\n"
+        desc += f"• Evictions: {cache.evictions}\n"
+        desc += f"• Guilds with unwritten changes: {len(self.dirty)}"
+        await self.bot.DefaultEmbedResponses.information_embed(self.bot, ctx, "Config cache", desc=desc)
+
 
 async def setup(bot) -> None:
     await bot.add_cog(Config(bot))
@@ -2,42 +2,170 @@ from discord.ext import commands
 import asyncio
 import asyncpg
 import datetime
+import heapq
+import os
+import socket
+import time
 from typing import Callable
 
 
 class Tasks(commands.Cog):
+    LEASE_COLUMNS = {"claimed_by": "text", "lease_expires": "timestamptz"}
+
     def __init__(self, bot) -> None:
         self.bot = bot
         self.task_types = {}
         self.bot.tasks = self
 
+        self.timers = []  # heap of (task_time, id) for every task row known to be pending
+        self.scheduled = set()  # ids currently in self.timers, stops duplicates coming back via NOTIFY
+        self.held = []  # timers that came due before their task type was registered
+        self.wakeup = asyncio.Event()
+        self.running = False
+        self.listener = None  # connection held for LISTEN, if a notify channel is configured
+        self.notify_channel = None
+        self.batches = set()  # batches of tasks currently being handled
+        self.batch_size = 100
+        self.concurrency = {}  # task_name -> max handlers running at once, overrides what the cog registered with
+        self.lease_seconds = 300  # how long a claim lasts without being renewed, after which another process may take the task over
+        self.reload_seconds = self.lease_seconds  # how often the DB is checked for tasks this process wasn't told about, e.g. leases left behind by a crashed process
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"  # written to claimed_by so processes sharing the DB can tell their claims apart
+
     @commands.Cog.listener()
     async def on_ready(self) -> None:
+        if self.running:
+            return  # on_ready fires again on reconnects, only ever want one scheduler
+
+        self.running = True
         while not self.bot.online:
             await asyncio.sleep(1)  # wait else DB won't be available
 
+        config = self.bot.cog_handler.give_config(self) or {}
+        self.notify_channel = config.get("notify_channel")
+        self.batch_size = config.get("batch_size", self.batch_size)
+        self.concurrency = config.get("concurrency", self.concurrency)
+        self.lease_seconds = config.get("lease_seconds", self.lease_seconds)
+        self.reload_seconds = config.get("reload_seconds", self.lease_seconds)
+        await self.add_columns(self.LEASE_COLUMNS)
+        await self.load_timers()
+        await self.listen()
         await self.execute_tasks()
 
-    async def register_task_type(self, task_name: str, handling_method: Callable, delete_task: bool = True, needs_extra_columns=None) -> None:  # expose to bot object
-        if needs_extra_columns is None:
-            needs_extra_columns = {"member_id": "bigint", "guild_id": "bigint"}
+    async def cog_unload(self) -> None:
+        self.running = False
+        self.wakeup.set()
+        if self.listener:
+            await self.bot.pool.release(self.listener)
+            self.listener = None
+
+    @staticmethod
+    def utc(timestamp: datetime.datetime) -> datetime.datetime:
+        """
+        Returns `timestamp` as an aware UTC datetime - naive datetimes are assumed to already be in UTC (as datetime.utcnow() gives)
+        """
+
+        return timestamp.replace(tzinfo=datetime.timezone.utc) if timestamp.tzinfo is None else timestamp.astimezone(datetime.timezone.utc)
+
+    def schedule(self, task_id: int, task_time: datetime.datetime) -> None:
+        """
+        Adds a task to the in-memory timer heap and wakes the scheduler if it is now the next one due
+        """
+
+        if task_id in self.scheduled:
+            return
+
+        task_time = self.utc(task_time)
+        self.scheduled.add(task_id)
+        heapq.heappush(self.timers, (task_time, task_id))
+        if self.timers[0][1] == task_id:
+            self.wakeup.set()
+
+    async def load_timers(self, within: float = None) -> None:
+        """
+        Fills the timer heap with every pending task in the DB (or only those due in the next `within` seconds), executed on startup and then every `reload_seconds`.
+        Tasks claimed by another process (or by this one before a crash) are scheduled for when their lease runs out, in case it is never renewed.
+        """
+
+        async with self.bot.pool.acquire() as connection:
+            tasks = await connection.fetch("SELECT id, GREATEST(task_time, lease_expires) AS due_at FROM tasks WHERE $1::float8 IS NULL OR GREATEST(task_time, lease_expires) <= now() + make_interval(secs => $1::float8)", within)
+
+        for task in tasks:
+            if task["due_at"] is not None:
+                self.schedule(task["id"], task["due_at"])
+
+    async def reload(self) -> None:
+        """
+        Picks up tasks that other processes submitted or left behind without this one hearing about it, and gets the NOTIFY listener back if its connection dropped
+        """
+
+        if self.notify_channel and (not self.listener or self.listener.is_closed()):
+            await self.listen()
+        await self.load_timers(within=self.reload_seconds * 2)  # overlap with the next reload so nothing falls between them
+
+    async def listen(self) -> None:
+        """
+        Subscribes to the notify channel (if one is configured in config_tasks.json) so tasks submitted by other processes wake this one
+        """
+
+        if not self.notify_channel:
+            return
+
+        if self.listener:  # connection dropped, swap it for a new one
+            await self.bot.pool.release(self.listener)
+            self.listener = None
+
+        def on_notify(connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+            try:
+                task_id, task_time = payload.split(" ", 1)
+                self.schedule(int(task_id), datetime.datetime.fromisoformat(task_time))
+            except ValueError:
+                print(f"Ignoring malformed task notification '{payload}'")
+
+        try:
+            self.listener = await self.bot.pool.acquire()
+            await self.listener.add_listener(self.notify_channel, on_notify)
+        except Exception as e:
+            if self.listener:
+                await self.bot.pool.release(self.listener)
+                self.listener = None
+            print(f"Could not listen for task notifications, only tasks submitted by this process will be picked up\n{type(e).__name__}: {e}")
+
+    async def add_columns(self, columns: dict) -> bool:
+        """
+        Adds any of `columns` ({name: type}) that the tasks table doesn't have yet, returns whether it succeeded
+        """
+
         while not self.bot.online:
             await asyncio.sleep(1)  # wait else DB won't be available
 
         async with self.bot.pool.acquire() as connection:
             try:
-                for column in needs_extra_columns:
-                    await connection.execute(f"ALTER TABLE tasks ADD COLUMN IF NOT EXISTS {column} {needs_extra_columns[column]}")
+                for column in columns:
+                    await connection.execute(f"ALTER TABLE tasks ADD COLUMN IF NOT EXISTS {column} {columns[column]}")
             except Exception as e:
                 print(e)
-                return
+                return False
+        return True
+
+    async def register_task_type(self, task_name: str, handling_method: Callable, delete_task: bool = True, needs_extra_columns=None, concurrency: int = 5) -> None:  # expose to bot object
+        if needs_extra_columns is None:
+            needs_extra_columns = {"member_id": "bigint", "guild_id": "bigint"}
+
+        if not await self.add_columns({**self.LEASE_COLUMNS, **needs_extra_columns}):
+            return
 
         self.task_types[task_name] = {
             "handler": handling_method,
             "delete_post_handle": delete_task,
-            "extra_data": needs_extra_columns
+            "extra_data": needs_extra_columns,
+            "slots": asyncio.Semaphore(self.concurrency.get(task_name, concurrency))
         }
 
+        # Anything held back waiting for a handler goes back on the heap, if it's still not handled it'll just be held again
+        held, self.held = self.held, []
+        for task_time, task_id in held:
+            self.schedule(task_id, task_time)
+
     async def submit_task(self, task_name: str, timestamp: str | datetime.datetime, extra_columns: dict) -> None:
         while not self.bot.online:
             await asyncio.sleep(1)  # wait else DB won't be available
@@ -47,39 +175,150 @@ class Tasks(commands.Cog):
 
         async with self.bot.pool.acquire() as connection:
             try:
-                await connection.execute(f"INSERT INTO tasks (task_name, task_time, {', '.join(extra_columns)}) values ($1, $2, {''.join([f', ${i+3}' for i in range(len(extra_columns))])[2:]})", task_name, timestamp, *extra_columns.values())
+                task = await connection.fetchrow(f"INSERT INTO tasks (task_name, task_time, {', '.join(extra_columns)}) values ($1, $2, {''.join([f', ${i+3}' for i in range(len(extra_columns))])[2:]}) RETURNING id, task_time", task_name, timestamp, *extra_columns.values())
+                if self.notify_channel:
+                    await connection.execute("SELECT pg_notify($1, $2)", self.notify_channel, f"{task['id']} {self.utc(task['task_time']).isoformat()}")
             except Exception as e:
                 raise e
 
+        self.schedule(task["id"], task["task_time"])
+
+    def pop_due(self, now: datetime.datetime) -> list[tuple[datetime.datetime, int]]:
+        """
+        Removes and returns the timers that are due at `now`, at most `self.batch_size` of them
+        """
+
+        due = []
+        while self.timers and self.timers[0][0] <= now and len(due) < self.batch_size:
+            timer = heapq.heappop(self.timers)
+            self.scheduled.discard(timer[1])
+            due.append(timer)
+        return due
+
+    async def claim_tasks(self, due: list[tuple[datetime.datetime, int]]) -> list[dict]:
+        """
+        Takes out a lease on the due rows for this process and returns them. Rows that another process holds an unexpired lease on
+        are rescheduled for when that lease runs out, so they get picked up if that process dies. Rows with a task type that hasn't
+        been registered here yet are held until it is.
+        """
+
+        due_ids = [task_id for task_time, task_id in due]
+        async with self.bot.pool.acquire() as connection:
+            tasks = await connection.fetch("""UPDATE tasks SET claimed_by = $2, lease_expires = now() + make_interval(secs => $3) WHERE id IN (
+                                                  SELECT id FROM tasks WHERE id = ANY($1::int[]) AND task_name = ANY($4::text[]) AND task_time <= now()
+                                                  AND (lease_expires IS NULL OR lease_expires <= now()) FOR UPDATE SKIP LOCKED
+                                              ) RETURNING *""", due_ids, self.instance_id, self.lease_seconds, list(self.task_types))
+            tasks = [dict(task) for task in tasks]
+
+            claimed_ids = {task["id"] for task in tasks}
+            missed = await connection.fetch("SELECT id, task_name, task_time, lease_expires FROM tasks WHERE id = ANY($1::int[])", [task_id for task_id in due_ids if task_id not in claimed_ids]) if len(claimed_ids) != len(due_ids) else []
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for task in missed:  # rows not returned at all were deleted since being scheduled, so they're done with
+            if task["task_name"] not in self.task_types:
+                self.held.append((self.utc(task["task_time"]), task["id"]))  # task_type hasn't been registered yet, hold task
+            elif task["lease_expires"] is not None and self.utc(task["lease_expires"]) > now:
+                self.schedule(task["id"], task["lease_expires"])
+            else:
+                self.schedule(task["id"], max(self.utc(task["task_time"]), now + datetime.timedelta(seconds=1)))  # locked mid-claim by another process, look again shortly
+
+        return tasks
+
+    async def renew_leases(self, task_ids: list[int]) -> None:
+        """
+        Keeps extending the leases on `task_ids` while they are being handled, so slow handlers aren't taken over by another process
+        """
+
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with self.bot.pool.acquire() as connection:
+                    await connection.execute("UPDATE tasks SET lease_expires = now() + make_interval(secs => $3) WHERE id = ANY($1::int[]) AND claimed_by = $2", task_ids, self.instance_id, self.lease_seconds)
+            except (OSError, asyncpg.exceptions.ConnectionDoesNotExistError):
+                pass  # try again next time round, the lease still has some time left
+
+    async def run_task(self, task: dict) -> None:
+        """
+        Runs the handler for a single claimed task, waiting for a free slot for its task type first
+        """
+
+        task_type = self.task_types[task["task_name"]]
+        async with task_type["slots"]:
+            try:
+                await task_type["handler"](task)
+            except Exception as e:
+                print(f"{type(e).__name__}: {e}")
+
+    async def run_batch(self, tasks: list[dict]) -> None:
+        """
+        Runs a batch of leased tasks concurrently, then deletes (or releases) all of them in one go
+        """
+
+        renewer = asyncio.create_task(self.renew_leases([task["id"] for task in tasks]))
+        try:
+            await asyncio.gather(*[self.run_task(task) for task in tasks])
+        finally:
+            renewer.cancel()
+
+        finished = [task["id"] for task in tasks if self.task_types[task["task_name"]]["delete_post_handle"]]
+        kept = [task["id"] for task in tasks if not self.task_types[task["task_name"]]["delete_post_handle"]]
+        try:
+            async with self.bot.pool.acquire() as connection:
+                if finished:
+                    await connection.execute("DELETE FROM tasks WHERE id = ANY($1::int[]) AND claimed_by = $2", finished, self.instance_id)
+                if kept:
+                    await connection.execute("UPDATE tasks SET claimed_by = NULL, lease_expires = NULL WHERE id = ANY($1::int[]) AND claimed_by = $2", kept, self.instance_id)
+        except (OSError, asyncpg.exceptions.ConnectionDoesNotExistError) as e:
+            print(f"Could not clean up {len(tasks)} handled tasks, they will be retried once their leases expire\n{type(e).__name__}: {e}")
+
     async def execute_tasks(self) -> None:
         """
-        The loop that continually checks the DB for todos.
+        The loop that executes todos from the DB. Rather than polling, it sleeps until the earliest timer in the heap is due
+        (or until it gets woken up by a new task) and only then goes to the DB.
+        Due tasks are leased and handed off as a batch so that slow handlers never hold up the loop or a pool connection, and so
+        that any number of processes can share the same tasks table without handling a task twice.
             The todo table looks like:
                 id SERIAL PRIMARY KEY,
                 task_name VARCHAR(255),
                 task_time timestamptz,
+                claimed_by text,
+                lease_expires timestamptz,
                 member_id bigint,
                 guild_id bigint
         """
 
-        while self.bot.online:
-            try:
-                async with self.bot.pool.acquire() as connection:
-                    tasks = await connection.fetch("SELECT * FROM tasks WHERE task_time <= ($1)", datetime.datetime.utcnow())
-                    for task in tasks:
-                        task = dict(task)
-                        try:
-                            if task["task_name"] not in self.task_types:
-                                continue  # task_type hasn't been registered yet, hold task
-                            await self.task_types[task["task_name"]]["handler"](task)
-                        except Exception as e:
-                            print(f"{type(e).__name__}: {e}")
-                        if self.task_types[task["task_name"]]["delete_post_handle"]:
-                            await connection.execute("DELETE FROM tasks WHERE id = ($1)", task["id"])
-            except (OSError, asyncpg.exceptions.ConnectionDoesNotExistError):
-                await asyncio.sleep(1)  # workaround for task crashing when connection temporarily drops with db
+        next_reload = time.monotonic() + self.reload_seconds
+        while self.bot.online and self.running:
+            self.wakeup.clear()
+            if time.monotonic() >= next_reload:
+                next_reload = time.monotonic() + self.reload_seconds
+                try:
+                    await self.reload()
+                except (OSError, asyncpg.exceptions.PostgresError, asyncpg.exceptions.InterfaceError) as e:
+                    print(f"Could not reload tasks, trying again in {self.reload_seconds} seconds\n{type(e).__name__}: {e}")
+
+            due = self.pop_due(datetime.datetime.now(datetime.timezone.utc))
+            if due:
+                try:
+                    tasks = await self.claim_tasks(due)
+                except (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresError, asyncpg.exceptions.InterfaceError):
+                    for task_time, task_id in due:
+                        self.schedule(task_id, task_time)  # workaround for task crashing when connection temporarily drops with db
+                    await asyncio.sleep(1)
+                    continue
 
-            await asyncio.sleep(1)
+                if tasks:
+                    batch = asyncio.create_task(self.run_batch(tasks))
+                    self.batches.add(batch)  # keep a reference else the batch can get garbage collected mid-run
+                    batch.add_done_callback(self.batches.discard)
+                continue  # there may be more due than fit in one batch, so check the heap again before sleeping
+
+            timeout = (self.timers[0][0] - datetime.datetime.now(datetime.timezone.utc)).total_seconds() if self.timers else None
+            timeout = min(timeout, next_reload - time.monotonic()) if timeout is not None else next_reload - time.monotonic()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
 
 async def setup(bot) -> None:
@@ -1,5 +1,94 @@
+import re
+import time
+
 import asyncpg
 
+from libs.misc.metrics import registry as metrics
+
+
+def query_label(query: str) -> str:
+    """
+    Turns a query into a short label for metrics, with literal numbers and strings replaced so that queries built with f-strings
+    don't each get their own series
+    """
+
+    query = re.sub(r"'[^']*'", "?", query)
+    query = re.sub(r"\b\d+\b", "?", query)
+    return " ".join(query.split())[:100]
+
+
+class InstrumentedConnection(asyncpg.Connection):
+    """
+    Connection that times every query into the `db_query_seconds` metric, pass as `connection_class` to asyncpg.create_pool
+    """
+
+    async def execute(self, query: str, *args, **kwargs):
+        with metrics.timer("db_query_seconds", {"query": query_label(query)}):
+            return await super().execute(query, *args, **kwargs)
+
+    async def executemany(self, command: str, args, **kwargs):
+        with metrics.timer("db_query_seconds", {"query": query_label(command)}):
+            return await super().executemany(command, args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs):
+        with metrics.timer("db_query_seconds", {"query": query_label(query)}):
+            return await super().fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        with metrics.timer("db_query_seconds", {"query": query_label(query)}):
+            return await super().fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        with metrics.timer("db_query_seconds", {"query": query_label(query)}):
+            return await super().fetchval(query, *args, **kwargs)
+
+
+class _TimedAcquire:
+    """
+    Stands in for asyncpg's PoolAcquireContext, so both `async with pool.acquire()` and `await pool.acquire()` still work
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool, timeout: float = None) -> None:
+        self.pool = pool
+        self.timeout = timeout
+        self.connection = None
+
+    async def _acquire(self) -> asyncpg.Connection:
+        start = time.perf_counter()
+        connection = await self.pool.acquire(timeout=self.timeout)
+        metrics.observe("db_pool_wait_seconds", time.perf_counter() - start)
+        return connection
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        self.connection = await self._acquire()
+        return self.connection
+
+    async def __aexit__(self, *exc) -> None:
+        connection, self.connection = self.connection, None
+        await self.pool.release(connection)
+
+
+class InstrumentedPool:
+    """
+    Wraps an asyncpg pool to time how long acquiring a connection waits, everything else is passed straight through to the pool
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool) -> None:
+        self._pool = pool
+
+    def acquire(self, *, timeout: float = None) -> _TimedAcquire:
+        return _TimedAcquire(self._pool, timeout=timeout)
+
+    def __getattr__(self, item: str):
+        return getattr(self._pool, item)
+
+
+async def create_pool(dsn: str, **kwargs) -> InstrumentedPool:
+    return InstrumentedPool(await asyncpg.create_pool(dsn, connection_class=InstrumentedConnection, **kwargs))
+
 
 async def introduce_tables(pool: asyncpg.pool.Pool, table_collection: list[dict]) -> None:
     async with pool.acquire() as connection:
@@ -0,0 +1,131 @@
+"""
+Renders matplotlib charts in worker processes so that plotting never blocks the event loop.
+
+Charts are described as plain dicts of data (see `line_chart`) so they can be pickled over to the workers, which hand back PNG bytes.
+Finished charts are cached by a key along with the version of the data they were drawn from, so asking for the same chart again isn't redrawn until the data changes.
+Versions should come from the data itself (e.g. the chart dict) rather than a counter kept in memory, which other processes sharing the DB wouldn't see.
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Callable, Hashable, Optional
+
+
+def _warm_up() -> None:
+    """
+    Runs once in each worker process, picking the non-interactive backend and drawing a throwaway figure so fonts etc. are already loaded for the first real chart
+    """
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.plot([0, 1], [0, 1])
+    fig.savefig(BytesIO(), format="png")
+    plt.close(fig)
+
+
+def line_chart(chart: dict) -> bytes:
+    """
+    Draws a line chart and returns it as PNG bytes. `chart` is made up of:
+        - "lines": list of {"x": list, "y": list} dicts, optionally with "label", "colour" (RGB floats from 0 to 1), "style" (matplotlib format string), "linewidth" and "markersize"
+        - "title", "xlabel" and "ylabel"
+        - "legend": whether to show the legend
+        - "dates": whether the x values are datetimes
+    """
+
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import DateFormatter
+
+    fig, ax = plt.subplots()
+    try:
+        for line in chart["lines"]:
+            options = {"linewidth": line.get("linewidth", 1), "markersize": line.get("markersize", 2)}
+            if line.get("colour"):
+                options["color"] = line["colour"]
+            if line.get("label"):
+                options["label"] = line["label"]
+            ax.plot(line["x"], line["y"], line.get("style", "-"), **options)
+
+        ax.set(xlabel=chart.get("xlabel", ""), ylabel=chart.get("ylabel", ""), title=chart.get("title", ""))
+        ax.grid()
+        ax.set_ylim(bottom=0)
+        if chart.get("legend"):
+            ax.legend(loc="upper left")
+        if chart.get("dates"):
+            ax.fmt_xdata = DateFormatter("%Y-%m-%d %H:%M:%S")
+            fig.autofmt_xdate()
+
+        buf = BytesIO()
+        fig.savefig(buf, format="png")
+        return buf.getvalue()
+    finally:
+        plt.close(fig)  # Figures otherwise live on in pyplot's figure manager for the life of the process
+
+
+class ChartRenderer:
+    def __init__(self, workers: int = 1, cache_size: int = 64) -> None:
+        self.workers = workers
+        self.cache_size = cache_size
+        self.executor = None  # Started on first use, see get_executor
+        self.cache = OrderedDict()  # Links key -> (version, PNG bytes), least recently used first
+        self.rendering = {}  # Links (key, version) -> future of the PNG bytes, so identical requests made while it's drawing share the one render
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if not self.executor:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_up)
+        return self.executor
+
+    def _store(self, key: Hashable, version: Hashable, future: asyncio.Future) -> None:
+        self.rendering.pop((key, version), None)
+        if future.cancelled() or future.exception():
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.executor = None  # A worker died, start a fresh pool next time
+            return
+        if key is None:
+            return
+
+        self.cache[key] = (version, future.result())
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def cached(self, key: Hashable, version: Hashable) -> Optional[bytes]:
+        """
+        Returns the cached chart for `key` if it was drawn from `version` of the data
+        """
+
+        cached = self.cache.get(key)
+        if cached and cached[0] == version:
+            self.cache.move_to_end(key)
+            return cached[1]
+
+    async def render(self, renderer: Callable[[dict], bytes], chart: dict, key: Optional[Hashable] = None, version: Hashable = None) -> bytes:
+        """
+        Returns the PNG bytes of `renderer(chart)`, drawn in a worker process.
+
+        If `key` is given the result is cached under it, and given back without drawing while `version` stays the same.
+        `renderer` must be a module level function so it can be pickled.
+        """
+
+        if key is not None:
+            cached = self.cached(key, version)
+            if cached:
+                return cached
+            if (key, version) in self.rendering:
+                return await asyncio.shield(self.rendering[(key, version)])
+
+        future = asyncio.get_running_loop().run_in_executor(self.get_executor(), renderer, chart)
+        if key is not None:
+            self.rendering[(key, version)] = future
+        future.add_done_callback(lambda f: self._store(key, version, f))
+        return await asyncio.shield(future)  # A cancelled command shouldn't cancel a render others may be waiting on
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,142 @@
+"""
+In-process metrics for finding out where the event loop's time goes.
+
+Counters count things (e.g. events dispatched), summaries keep the count and total of timed things (e.g. listener run time) along with
+a reservoir of the most recent samples that the p50/p95/p99 are worked out from.
+Everything can be rendered as Prometheus-style text, which `serve` exposes over HTTP on localhost.
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+def _label_key(labels: Optional[dict]) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    return "{" + ",".join([f'{name}="{_escape(value)}"' for name, value in labels]) + "}" if labels else ""
+
+
+class Metrics:
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, sample_size: int = 1024, max_series: int = 1000) -> None:
+        self.sample_size = sample_size  # how many recent samples each summary keeps for its quantiles
+        self.max_series = max_series  # cap on distinct label sets per metric, anything past it is lumped into "other"
+        self.counters = {}  # name -> {label key: value}
+        self.summaries = {}  # name -> {label key: {"samples": deque, "count": int, "sum": float}}
+        self.descriptions = {}  # name -> help text
+
+    def describe(self, name: str, description: str) -> None:
+        self.descriptions[name] = description
+
+    def _series(self, metrics: dict, name: str, labels: Optional[dict], default) -> tuple:
+        series = metrics.setdefault(name, {})
+        key = _label_key(labels)
+        if key not in series:
+            if len(series) >= self.max_series:
+                key = tuple((label, "other") for label, value in key)
+                if key in series:
+                    return key
+            series[key] = default()
+        return key
+
+    def increment(self, name: str, labels: Optional[dict] = None, amount: int = 1) -> None:
+        key = self._series(self.counters, name, labels, int)
+        self.counters[name][key] += amount
+
+    def observe(self, name: str, value: float, labels: Optional[dict] = None) -> None:
+        key = self._series(self.summaries, name, labels, lambda: {"samples": deque(maxlen=self.sample_size), "count": 0, "sum": 0.0})
+        summary = self.summaries[name][key]
+        summary["samples"].append(value)
+        summary["count"] += 1
+        summary["sum"] += value
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[dict] = None) -> Iterator[None]:
+        """
+        Times the block it wraps, in seconds, into the summary `name`
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    @classmethod
+    def quantiles(cls, samples: deque) -> dict[float, float]:
+        ordered = sorted(samples)
+        if not ordered:
+            return {q: 0.0 for q in cls.QUANTILES}
+        return {q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] for q in cls.QUANTILES}
+
+    def summary_rows(self, name_filter: str = "") -> list[list]:
+        """
+        Returns [name, labels, count, p50, p95, p99] for every summary whose name or labels contain `name_filter`, slowest p99 first
+        """
+
+        rows = []
+        for name, series in self.summaries.items():
+            for key, summary in series.items():
+                labels = ", ".join([f"{label}={value}" for label, value in key])
+                if name_filter and name_filter not in name and name_filter not in labels:
+                    continue
+                q = self.quantiles(summary["samples"])
+                rows.append([name, labels, summary["count"], q[0.5], q[0.95], q[0.99]])
+        return sorted(rows, key=lambda row: row[5], reverse=True)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, series in self.counters.items():
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} counter")
+            lines += [f"{name}{_format_labels(key)} {value}" for key, value in series.items()]
+
+        for name, series in self.summaries.items():
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for key, summary in series.items():
+                for q, value in self.quantiles(summary["samples"]).items():
+                    lines.append(f"{name}{_format_labels(key, (('quantile', str(q)),))} {value}")
+                lines.append(f"{name}_sum{_format_labels(key)} {summary['sum']}")
+                lines.append(f"{name}_count{_format_labels(key)} {summary['count']}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int, host: str = "127.0.0.1") -> asyncio.AbstractServer:
+        """
+        Starts a minimal HTTP server that answers every request with the metrics in Prometheus text format
+        """
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                await reader.readuntil(b"\r\n\r\n")  # request itself doesn't matter, there's only one thing to serve
+                body = self.to_prometheus().encode("utf-8")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                             + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("utf-8") + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+registry = Metrics()
+registry.describe("events_total", "Gateway events dispatched")
+registry.describe("listener_seconds", "Time taken by each event listener")
+registry.describe("command_seconds", "Time taken by each command invocation")
+registry.describe("db_query_seconds", "Time taken by each DB query")
+registry.describe("db_pool_wait_seconds", "Time spent waiting for a DB pool connection")
@@ -11,9 +11,11 @@ import asyncio
 
 class EmbedPages:
     def __init__(self, page_type: int, data: list, title: str, colour: Colour, bot, initiator: discord.Member, channel: discord.TextChannel | discord.Thread, desc: str = "", thumbnail_url: str = "",
-                 footer: str = "", icon_url: str = "") -> None:
+                 footer: str = "", icon_url: str = "", page_loader=None, total: int = 0) -> None:
         self.bot = bot
         self.data = data
+        self.page_loader = page_loader  # If given, awaited with (page_num, page_length) to get just that page's rows instead of slicing `data`
+        self.total = total  # Number of rows available to `page_loader`
         self.title = title
         self.page_type = page_type
         self.top_limit = 0
@@ -37,13 +39,14 @@ class EmbedPages:
         """
 
         if self.page_type == PageTypes.REP:
-            self.data = [x for x in self.data if self.channel.guild.get_member(x[0]) is not None]
+            if not self.page_loader:
+                self.data = [x for x in self.data if self.channel.guild.get_member(x[0]) is not None]
             page_length = 10
         elif self.page_type == PageTypes.ROLE_LIST:
             page_length = 10
         else:
             page_length = 5
-        self.top_limit = ceil(len(self.data) / page_length)
+        self.top_limit = ceil((self.total if self.page_loader else len(self.data)) / page_length)
 
         # Clear previous data
         self.embed = Embed(title=f"{self.title} (Page {page_num}/{self.top_limit})", color=self.colour,
@@ -61,7 +64,11 @@ class EmbedPages:
         # Gettings the wanted data
         self.page_num = page_num
         page_num -= 1
-        for i in range(page_length * page_num, min(page_length * page_num + page_length, len(self.data))):
+        start = page_length * page_num
+        if self.page_loader:
+            self.data = await self.page_loader(self.page_num, page_length)
+            start = 0  # Only this page's rows were loaded
+        for i in range(start, min(start + page_length, len(self.data))):
             if self.page_type == PageTypes.QOTD:
                 question_id = self.data[i][0]
                 question = self.data[i][1]
@@ -93,7 +100,10 @@ class EmbedPages:
 
             elif self.page_type == PageTypes.REP:
                 member = self.channel.guild.get_member(self.data[i][0])
-                self.embed.add_field(name=f"{member.display_name}", value=f"{self.data[i][1]}", inline=False)
+                name = member.display_name if member else str(self.data[i][0])
+                if len(self.data[i]) > 2:  # Rank was given too
+                    name = f"{self.bot.ordinal(self.data[i][2])} • {name}"
+                self.embed.add_field(name=name, value=f"{self.data[i][1]}", inline=False)
 
             elif self.page_type == PageTypes.CONFIG:
                 config_key = list(self.data.keys())[i]  # Change the index into the key
@@ -212,14 +222,20 @@ DEVS = [
 CODE_URL = "https://github.com/adampy/adambot"
 
 
-async def send_image_file(fig, channel: discord.TextChannel | discord.Thread, filename: str, extension: str = "png") -> None:
+async def send_image_file(image, channel: discord.TextChannel | discord.Thread, filename: str, extension: str = "png") -> None:
     """
-    Send data to a channel with filename `filename`
+    Send an image to a channel with filename `filename`.
+    `image` should be the bytes of the image, e.g. from bot.charts. A matplotlib figure is also accepted, but is saved in a thread and then closed
     """
 
-    buf = BytesIO()
-    fig.savefig(buf)
-    buf.seek(0)
+    if isinstance(image, bytes):
+        buf = BytesIO(image)
+    else:
+        import matplotlib.pyplot as plt  # Only needed for this fallback
+        buf = BytesIO()
+        await asyncio.get_running_loop().run_in_executor(None, image.savefig, buf)
+        plt.close(image)
+        buf.seek(0)
     await channel.send(file=File(buf, filename=f"{filename}.{extension}"))
 
 